@@ -1,7 +1,28 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from contextlib import contextmanager
+import csv
+import datetime
+import functools
+import io
+import json
+import logging
+import select
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import weakref
 import os
+import re
 
 # --- INITIALISATION DE L'ÉTAT ET DE LA CONFIGURATION ---
 
@@ -14,67 +35,1094 @@ if 'cart_cash' not in st.session_state:
 st.set_page_config(page_title="Gestion Stock & Crédit", layout="wide")
 st.title("🛒 Gestion de Stock, Crédit et Paiements")
 
+# --- INSTRUMENTATION DES REQUÊTES ---
+
+# Mesure de chaque requête (durée, lignes, erreurs) via les fabriques de connexion/curseur de psycopg2 :
+# exec_query, les lectures en cache, pd.read_sql, les transactions de vente et les COPY sont tous couverts.
+QUERY_METRICS = os.environ.get('QUERY_METRICS', '1') == '1'
+# Requêtes plus lentes (ms) journalisées, dans SLOW_QUERY_LOG si défini (sinon sur la sortie d'erreur)
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', '')
+# Fichier au format texte Prometheus (collecteur « textfile »), réécrit toutes les METRICS_EXPORT_INTERVAL s
+METRICS_EXPORT_PATH = os.environ.get('METRICS_EXPORT_PATH', '')
+METRICS_EXPORT_INTERVAL = float(os.environ.get('METRICS_EXPORT_INTERVAL', '15'))
+# Panneau de la barre latérale avec le détail des requêtes du rerun courant
+ADMIN_METRICS = os.environ.get('ADMIN_METRICS', '0') == '1'
+
+DUREE_REQUETE_SEAUX = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DUREE_RERUN_SEAUX = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_RE_COMMENTAIRE = re.compile(r"--[^\n]*")
+_RE_LITTERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+# Tuples identiques répétés (VALUES générés par execute_values), avec un niveau de parenthèses imbriquées
+_RE_TUPLES = re.compile(r"(\((?:[^()]|\([^()]*\))*\))(?:\s*,\s*\1)+")
+
+
+def empreinte_sql(sql):
+    """Forme normalisée d'une requête (littéraux remplacés par ?, VALUES repliés) servant de clé d'agrégation."""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    elif not isinstance(sql, str):
+        sql = str(sql)
+    sql = ' '.join(_RE_LITTERAL.sub('?', _RE_COMMENTAIRE.sub('', sql)).split())
+    return _RE_TUPLES.sub(r'\1, ...', sql)
+
+
+class Histogramme:
+    """Histogramme cumulatif à seaux fixes, au sens de Prometheus."""
+
+    def __init__(self, seaux):
+        self.seaux = seaux
+        self.comptes = [0] * len(seaux)
+        self.somme = 0.0
+        self.total = 0
+
+    def observer(self, valeur):
+        self.somme += valeur
+        self.total += 1
+        for i, borne in enumerate(self.seaux):
+            if valeur <= borne:
+                self.comptes[i] += 1
+
+
+class RerunStats:
+    """Requêtes exécutées pendant un rerun de script (une session, un thread)."""
+
+    def __init__(self):
+        self.debut = time.perf_counter()
+        self.duree_s = None
+        self.emprunts = 0
+        self.connexions = 0
+        self.requetes = {}  # empreinte -> [nombre, durée s, lignes, erreurs]
+
+    def totaux(self):
+        lignes = self.requetes.values()
+        return {
+            'requetes': sum(r[0] for r in lignes),
+            'duree_sql_ms': 1000 * sum(r[1] for r in lignes),
+            'lignes': sum(r[2] for r in lignes),
+            'erreurs': sum(r[3] for r in lignes),
+            'emprunts_connexion': self.emprunts,
+            'connexions_ouvertes': self.connexions,
+        }
+
+
+class QueryMetrics:
+    """Compteurs de requêtes du processus, plus le détail du rerun en cours dans chaque thread de script."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.requetes = {}  # empreinte -> [nombre, durée s, lignes, erreurs]
+        self.duree_requetes = Histogramme(DUREE_REQUETE_SEAUX)
+        self.duree_reruns = Histogramme(DUREE_RERUN_SEAUX)
+        self.requetes_reruns = 0
+        self.connexions_ouvertes = 0
+        self.emprunts = 0
+        self.erreurs_connexion = 0
+        self.journal_lent = logging.getLogger('stock_app.requetes')
+        if SLOW_QUERY_LOG and not self.journal_lent.handlers:
+            handler = logging.FileHandler(SLOW_QUERY_LOG, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            self.journal_lent.addHandler(handler)
+
+    def enregistrer(self, sql, duree, lignes, erreur=None):
+        empreinte = empreinte_sql(sql)
+        erreurs = 1 if erreur is not None else 0
+        lignes = max(lignes, 0)
+        with self._lock:
+            stats = self.requetes.setdefault(empreinte, [0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += duree
+            stats[2] += lignes
+            stats[3] += erreurs
+            self.duree_requetes.observer(duree)
+        rerun = getattr(self._local, 'rerun', None)
+        if rerun is not None:
+            stats = rerun.requetes.setdefault(empreinte, [0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += duree
+            stats[2] += lignes
+            stats[3] += erreurs
+        if erreur is not None:
+            self.journal_lent.error("ERREUR %.1f ms : %s | %s", 1000 * duree, erreur, empreinte[:500])
+        elif 1000 * duree >= SLOW_QUERY_MS:
+            self.journal_lent.warning("LENTE %.1f ms, %d lignes : %s", 1000 * duree, lignes, empreinte[:500])
+
+    def connexion_ouverte(self):
+        with self._lock:
+            self.connexions_ouvertes += 1
+        rerun = getattr(self._local, 'rerun', None)
+        if rerun is not None:
+            rerun.connexions += 1
+
+    def emprunt(self, ok=True):
+        with self._lock:
+            if ok:
+                self.emprunts += 1
+            else:
+                self.erreurs_connexion += 1
+        rerun = getattr(self._local, 'rerun', None)
+        if ok and rerun is not None:
+            rerun.emprunts += 1
+
+    def debut_rerun(self):
+        self._local.rerun = RerunStats()
+
+    def rerun_en_cours(self):
+        return getattr(self._local, 'rerun', None) is not None
+
+    def fin_rerun(self):
+        """Clôt le rerun du thread courant et le verse dans les compteurs du processus ; renvoie son détail."""
+        rerun = getattr(self._local, 'rerun', None)
+        if rerun is None:
+            return None
+        self._local.rerun = None
+        rerun.duree_s = time.perf_counter() - rerun.debut
+        with self._lock:
+            self.duree_reruns.observer(rerun.duree_s)
+            self.requetes_reruns += rerun.totaux()['requetes']
+        return rerun
+
+    def prometheus(self, pool_stats=None):
+        """Export au format texte Prometheus 0.0.4."""
+        def label(texte):
+            return texte[:200].replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+        def histogramme(nom, h):
+            lignes = [f"# TYPE {nom} histogram"]
+            lignes += [f'{nom}_bucket{{le="{borne}"}} {n}' for borne, n in zip(h.seaux, h.comptes)]
+            lignes += [f'{nom}_bucket{{le="+Inf"}} {h.total}', f"{nom}_sum {h.somme}", f"{nom}_count {h.total}"]
+            return lignes
+
+        with self._lock:
+            requetes = {k: list(v) for k, v in self.requetes.items()}
+            sortie = histogramme('stock_app_requete_duree_secondes', self.duree_requetes)
+            sortie += histogramme('stock_app_rerun_duree_secondes', self.duree_reruns)
+            sortie += [
+                "# TYPE stock_app_rerun_requetes_total counter",
+                f"stock_app_rerun_requetes_total {self.requetes_reruns}",
+                "# TYPE stock_app_connexions_ouvertes_total counter",
+                f"stock_app_connexions_ouvertes_total {self.connexions_ouvertes}",
+                "# TYPE stock_app_emprunts_connexion_total counter",
+                f"stock_app_emprunts_connexion_total {self.emprunts}",
+                "# TYPE stock_app_erreurs_connexion_total counter",
+                f"stock_app_erreurs_connexion_total {self.erreurs_connexion}",
+            ]
+        for nom, indice in (('requetes', 0), ('requetes_duree_secondes', 1), ('requetes_lignes', 2), ('requetes_erreurs', 3)):
+            sortie.append(f"# TYPE stock_app_{nom}_total counter")
+            sortie += [f'stock_app_{nom}_total{{requete="{label(k)}"}} {v[indice]}' for k, v in requetes.items()]
+        for cle, valeur in (pool_stats or {}).items():
+            sortie += [f"# TYPE stock_app_pool_{cle} gauge", f"stock_app_pool_{cle} {valeur}"]
+        return "\n".join(sortie) + "\n"
+
+
+@st.cache_resource
+def get_query_metrics():
+    return QueryMetrics()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Curseur qui chronomètre chaque instruction et la déclare à QueryMetrics."""
+
+    def _mesurer(self, methode, sql, *args):
+        debut = time.perf_counter()
+        try:
+            resultat = methode(sql, *args)
+        except Exception as e:
+            get_query_metrics().enregistrer(sql, time.perf_counter() - debut, 0, e)
+            raise
+        get_query_metrics().enregistrer(sql, time.perf_counter() - debut, self.rowcount)
+        return resultat
+
+    def execute(self, sql, params=None):
+        return self._mesurer(super().execute, sql, params)
+
+    def executemany(self, sql, params_seq):
+        return self._mesurer(super().executemany, sql, params_seq)
+
+    def copy_expert(self, sql, fichier, size=8192):
+        return self._mesurer(super().copy_expert, sql, fichier, size)
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Connexion comptée à l'ouverture, dont les curseurs sont instrumentés."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+        get_query_metrics().connexion_ouverte()
+
+
+@st.cache_resource
+def start_metrics_export():
+    """Thread qui réécrit périodiquement le fichier Prometheus (remplacement atomique)."""
+    metrics = get_query_metrics()
+
+    def exporter():
+        while True:
+            time.sleep(METRICS_EXPORT_INTERVAL)
+            try:
+                temporaire = f"{METRICS_EXPORT_PATH}.tmp"
+                with open(temporaire, 'w', encoding='utf-8') as f:
+                    f.write(metrics.prometheus(get_db_pool().stats()))
+                os.replace(temporaire, METRICS_EXPORT_PATH)
+            except Exception as e:
+                metrics.journal_lent.error("Export des métriques impossible : %s", e)
+
+    thread = threading.Thread(target=exporter, name="metrics-export", daemon=True)
+    thread.start()
+    return thread
+
+
+if QUERY_METRICS:
+    get_query_metrics().debut_rerun()
+
+
+def cumuler_rerun(rerun_stats):
+    """Cumul de la session (lu par bench/benchmark.py pour rapporter le coût de chaque action)."""
+    cumul = st.session_state.setdefault('mesures_session', {'reruns': 0, 'duree_ms': 0.0})
+    cumul['reruns'] += 1
+    cumul['duree_ms'] += 1000 * rerun_stats.duree_s
+    for cle, valeur in rerun_stats.totaux().items():
+        cumul[cle] = cumul.get(cle, 0) + valeur
+
+
+@contextmanager
+def mesurer_fragment():
+    """Un rerun limité à un @st.fragment ne repasse ni par le début ni par la fin du script : il est mesuré ici.
+
+    Pendant un rerun complet, le fragment fait partie du rerun déjà ouvert et rien n'est fait.
+    """
+    if not QUERY_METRICS or get_query_metrics().rerun_en_cours():
+        yield
+        return
+    get_query_metrics().debut_rerun()
+    try:
+        yield
+    finally:
+        cumuler_rerun(get_query_metrics().fin_rerun())
+
+
+# --- STOCKAGE : POSTGRESQL OU SQLITE EMBARQUÉ ---
+
+# Le moteur est choisi par le schéma de DATABASE_URL : postgresql://... ou sqlite:///chemin/du/fichier.db
+# (une seule caisse : pas de serveur, requêtes locales en quelques microsecondes).
+DB_DIALECTE = 'sqlite' if os.environ.get('DATABASE_URL', '').startswith('sqlite:') else 'postgresql'
+# NORMAL en WAL : une coupure de courant peut perdre les dernières transactions, jamais corrompre la base
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_CACHE_MB = int(os.environ.get('SQLITE_CACHE_MB', '64'))
+
+# Réécritures du SQL PostgreSQL de l'application en SQL SQLite, appliquées hors des littéraux
+_RE_LITTERAUX_SQL = re.compile(r"('(?:[^']|'')*')")
+_TRADUCTIONS_SQLITE = [
+    (re.compile(r"\b(?:BIG)?SERIAL PRIMARY KEY\b", re.I), "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    (re.compile(r"\bADD COLUMN IF NOT EXISTS\b", re.I), "ADD COLUMN"),
+    (re.compile(r"\s+text_pattern_ops\b", re.I), ""),
+    (re.compile(r"\bILIKE\b", re.I), "LIKE"),
+    (re.compile(r"\bGREATEST\(", re.I), "MAX("),
+    (re.compile(r"\bLEAST\(", re.I), "MIN("),
+    # SQLite compte CURRENT_TIMESTAMP en UTC : les dates sont stockées à l'heure locale, comme les filtres
+    # (datetime.date.today()) ; un horodatage avec fuseau (journal d'écritures différées) y est ramené
+    (re.compile(r"\bDEFAULT\s+CURRENT_TIMESTAMP\b", re.I), "DEFAULT (datetime('now', 'localtime'))"),
+    (re.compile(r"\bCURRENT_TIMESTAMP\b", re.I), "datetime('now', 'localtime')"),
+    (re.compile(r"\bCURRENT_DATE\b", re.I), "date('now', 'localtime')"),
+    (re.compile(r"(%\(\w+\)s|%s|\b[\w.]+)::timestamptz\b", re.I), r"datetime(\1, 'localtime')"),
+    (re.compile(r"(%\(\w+\)s|%s|\b[\w.]+)::timestamp\b", re.I), r"datetime(\1)"),
+    (re.compile(r"(%\(\w+\)s|%s|\b[\w.]+)::date\b", re.I), r"date(\1)"),
+    (re.compile(r"(%\(\w+\)s|%s|\b[\w.]+)::(\w+)"), r"CAST(\1 AS \2)"),
+    (re.compile(r"%\((\w+)\)s"), r":\1"),
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"%%"), "%"),
+    # PostgreSQL échappe les motifs LIKE par la barre oblique inverse ; SQLite n'a pas d'échappement par défaut
+    (re.compile(r"\bLIKE\s+(\?|:\w+)(?!\s+ESCAPE)", re.I), r"LIKE \1 ESCAPE '\\'"),
+]
+# Instructions qui n'ouvrent pas de transaction d'écriture (lectures et contrôle de transaction)
+_RE_SANS_ECRITURE = re.compile(
+    r"\s*(?:SELECT|VALUES|EXPLAIN|PRAGMA|BEGIN|COMMIT|END|ROLLBACK|RELEASE)\b"
+    r"|\s*WITH\b(?![\s\S]*\b(?:INSERT|UPDATE|DELETE)\b)", re.I)
+
+
+@functools.lru_cache(maxsize=1024)
+def traduire_sql(sql):
+    """SQL de l'application (dialecte PostgreSQL, paramètres %s / %(nom)s) -> SQL SQLite (? / :nom)."""
+    morceaux = _RE_LITTERAUX_SQL.split(sql)
+    for i in range(0, len(morceaux), 2):
+        for motif, remplacement in _TRADUCTIONS_SQLITE:
+            morceaux[i] = motif.sub(remplacement, morceaux[i])
+    return ''.join(morceaux)
+
+
+def _adapter_horodatage(valeur):
+    return valeur.isoformat(' ')
+
+
+sqlite3.register_adapter(datetime.datetime, _adapter_horodatage)
+sqlite3.register_adapter(pd.Timestamp, lambda t: _adapter_horodatage(t.to_pydatetime()))
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_adapter(np.int64, int)
+sqlite3.register_adapter(np.float64, float)
+sqlite3.register_converter('TIMESTAMP', lambda b: datetime.datetime.fromisoformat(b.decode()))
+sqlite3.register_converter('DATE', lambda b: datetime.date.fromisoformat(b.decode()[:10]))
+
+
+class CurseurSQLite:
+    """Curseur SQLite au comportement de psycopg2 : SQL traduit, transaction ouverte à la première écriture, mesures."""
+
+    def __init__(self, connexion):
+        self.connexion = connexion
+        self._cur = connexion._conn.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def _executer(self, methode, sql, params):
+        traduit = traduire_sql(sql)
+        # BEGIN IMMEDIATE : le verrou d'écriture est pris d'emblée, jamais par promotion (source d'échecs « database is locked »)
+        if not self.connexion._conn.in_transaction and not _RE_SANS_ECRITURE.match(traduit):
+            self._cur.execute("BEGIN IMMEDIATE")
+        debut = time.perf_counter()
+        try:
+            methode(traduit, params)
+        except Exception as e:
+            if QUERY_METRICS:
+                get_query_metrics().enregistrer(sql, time.perf_counter() - debut, 0, e)
+            raise
+        if QUERY_METRICS:
+            get_query_metrics().enregistrer(sql, time.perf_counter() - debut, self._cur.rowcount)
+        return self
+
+    def execute(self, sql, params=None):
+        return self._executer(self._cur.execute, sql, params or ())
+
+    def executemany(self, sql, params_seq):
+        return self._executer(self._cur.executemany, sql, params_seq)
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cur.fetchmany(size or self._cur.arraysize)
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def close(self):
+        self._cur.close()
+
+
+class ConnexionSQLite:
+    """Connexion SQLite utilisable partout où le code attend une connexion psycopg2."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.closed = False
+
+    def cursor(self):
+        return CurseurSQLite(self)
+
+    def commit(self):
+        if self._conn.in_transaction:
+            self._conn.execute("COMMIT")
+
+    def rollback(self):
+        if self._conn.in_transaction:
+            self._conn.execute("ROLLBACK")
+
+    def close(self):
+        self._conn.close()
+        self.closed = True
+
+
+def ouvrir_sqlite(chemin):
+    # isolation_level=None : les transactions sont gérées par CurseurSQLite, pas par le module sqlite3
+    conn = sqlite3.connect(chemin, timeout=DB_POOL_TIMEOUT, isolation_level=None, check_same_thread=False,
+                           detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    if QUERY_METRICS:
+        get_query_metrics().connexion_ouverte()
+    return ConnexionSQLite(conn)
+
+
+class _ConnexionsSQLite:
+    """Équivalent de ThreadedConnectionPool (getconn / putconn) pour des connexions SQLite."""
+
+    def __init__(self, chemin):
+        self.chemin = chemin
+        self._lock = threading.Lock()
+        self._libres = []
+
+    def getconn(self):
+        with self._lock:
+            if self._libres:
+                return self._libres.pop()
+        return ouvrir_sqlite(self.chemin)
+
+    def putconn(self, conn, close=False):
+        if close:
+            conn.close()
+            return
+        with self._lock:
+            self._libres.append(conn)
+
+
 # --- FONCTIONS DE BASE DE DONNÉES SÉCURISÉES ---
 
+# Taille du pool de connexions partagé par toutes les sessions du processus : DB_POOL_MIN connexions
+# ouvertes au démarrage, jusqu'à DB_POOL_MAX ouvertes à la demande puis gardées au repos
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+# Délai max (s) d'attente d'une connexion libre avant d'abandonner
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+# Une connexion inactive depuis plus longtemps (s) est vérifiée (SELECT 1) avant d'être prêtée
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+
+class _PoolPersistant(ThreadedConnectionPool):
+    """ThreadedConnectionPool ferme à la restitution toute connexion au-delà de `minconn` : ici, seules
+    `minconn` sont ouvertes au démarrage mais toutes les connexions rendues restent au repos."""
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+
+
+class DBPool:
+    """Pool de connexions PostgreSQL avec contrôle de vie et métriques d'utilisation."""
+
+    def __init__(self, url, minconn, maxconn):
+        self._pool = self._creer_pool(url, minconn, maxconn)
+        # ThreadedConnectionPool lève PoolError quand il est plein : le sémaphore fait patienter à la place
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        # Clé : la connexion elle-même (et non id()) ; l'entrée disparaît avec la connexion
+        self._last_used = weakref.WeakKeyDictionary()
+        self.maxconn = maxconn
+        self.metrics = {
+            'emprunts': 0,
+            'en_cours': 0,
+            'pic_en_cours': 0,
+            'attente_totale_s': 0.0,
+            'attente_max_s': 0.0,
+            'reconnexions': 0,
+            'delais_depasses': 0,
+        }
+
+    def _creer_pool(self, url, minconn, maxconn):
+        if QUERY_METRICS:
+            return _PoolPersistant(minconn, maxconn, url, connection_factory=InstrumentedConnection)
+        return _PoolPersistant(minconn, maxconn, url)
+
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        last = self._last_used.get(conn)
+        # Connexion neuve ou utilisée récemment : inutile de faire un aller-retour
+        if last is None or time.monotonic() - last < DB_POOL_PING_AFTER:
+            return True
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except (psycopg2.Error, sqlite3.Error):
+            return False
+
+    def _discard(self, conn):
+        self._last_used.pop(conn, None)
+        self._pool.putconn(conn, close=True)
+
+    def acquire(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+            with self._lock:
+                self.metrics['delais_depasses'] += 1
+            raise PoolError(f"Aucune connexion libre après {DB_POOL_TIMEOUT:.0f} s (pool de {self.maxconn}).")
+        try:
+            conn = self._pool.getconn()
+            reconnexions = 0
+            # Reconnexion transparente : les connexions mortes sont fermées et remplacées
+            while not self._is_alive(conn):
+                self._discard(conn)
+                reconnexions += 1
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        wait = time.monotonic() - start
+        with self._lock:
+            m = self.metrics
+            m['emprunts'] += 1
+            m['en_cours'] += 1
+            m['pic_en_cours'] = max(m['pic_en_cours'], m['en_cours'])
+            m['attente_totale_s'] += wait
+            m['attente_max_s'] = max(m['attente_max_s'], wait)
+            m['reconnexions'] += reconnexions
+        return conn
+
+    def release(self, conn, broken=False):
+        try:
+            if broken or conn.closed:
+                self._discard(conn)
+            else:
+                # Ne jamais rendre au pool une connexion avec une transaction ouverte
+                conn.rollback()
+                self._last_used[conn] = time.monotonic()
+                self._pool.putconn(conn)
+        except (psycopg2.Error, sqlite3.Error):
+            self._discard(conn)
+        finally:
+            with self._lock:
+                self.metrics['en_cours'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+        stats['taille_max'] = self.maxconn
+        stats['attente_moyenne_ms'] = 1000 * stats['attente_totale_s'] / stats['emprunts'] if stats['emprunts'] else 0.0
+        return stats
+
+
+class SQLitePool(DBPool):
+    """Même pool (limite, attente, métriques) sur un fichier SQLite : lectures en parallèle, une écriture à la fois."""
+
+    def _creer_pool(self, url, minconn, maxconn):
+        chemin = url.split(':', 1)[1].removeprefix('//').removeprefix('/')
+        if not chemin:
+            raise ValueError("Chemin du fichier SQLite manquant (attendu : sqlite:///chemin/du/fichier.db).")
+        return _ConnexionsSQLite(chemin)
+
+
+@st.cache_resource
+def get_db_pool():
+    """Pool unique pour tout le processus (partagé entre sessions et reruns)."""
+    if DB_DIALECTE == 'sqlite':
+        return SQLitePool(os.environ['DATABASE_URL'], DB_POOL_MIN, DB_POOL_MAX)
+    return DBPool(os.environ['DATABASE_URL'], DB_POOL_MIN, DB_POOL_MAX)
+
+
+@contextmanager
 def get_db_connection():
-    """Tente d'établir une connexion à la base de données."""
+    """Emprunte une connexion au pool et la restitue à la sortie du bloc `with`."""
+    pool = get_db_pool()
     try:
-        url = os.environ.get('DATABASE_URL')
-        if not url:
-            st.error("DATABASE_URL non configuré. Vérifiez les secrets de l'application.")
-            return None
-        conn = psycopg2.connect(url)
-        return conn
-    except Exception as e:
-        st.error(f"Erreur de connexion DB: {e}")
-        return None
+        conn = pool.acquire()
+    except Exception:
+        if QUERY_METRICS:
+            get_query_metrics().emprunt(ok=False)
+        raise
+    if QUERY_METRICS:
+        get_query_metrics().emprunt()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.release(conn, broken)
+
+
+@contextmanager
+def db_transaction():
+    """Connexion du pool dont le travail est validé à la sortie du bloc, ou annulé en cas d'erreur."""
+    with get_db_connection() as conn:
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+
+# --- CACHE DES LECTURES (INVALIDÉ PAR LES ÉCRITURES) ---
+
+# Durée de vie (s) et nombre max d'entrées des lectures mises en cache
+CACHE_TTL = int(os.environ.get('CACHE_TTL', '300'))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '256'))
+# LISTEN/NOTIFY : propage les écritures aux autres processus serveur qui partagent la base (PostgreSQL seulement)
+CACHE_LISTEN_NOTIFY = os.environ.get('CACHE_LISTEN_NOTIFY', '0') == '1' and DB_DIALECTE == 'postgresql'
+CACHE_NOTIFY_CHANNEL = 'stock_app_ecritures'
+
+
+class DataVersion:
+    """Compteur incrémenté à chaque écriture ; il fait partie de la clé de toutes les lectures en cache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def bump(self):
+        with self._lock:
+            self.value += 1
+
+
+@st.cache_resource
+def get_data_version():
+    return DataVersion()
+
+
+def notify_write(cursor):
+    """À appeler dans la transaction d'écriture : invalide le cache de ce processus et, à la validation, des autres."""
+    if CACHE_LISTEN_NOTIFY:
+        cursor.execute(f"NOTIFY {CACHE_NOTIFY_CHANNEL}")
+
+
+@st.cache_resource
+def start_cache_listener():
+    """Thread qui écoute les NOTIFY des autres processus et invalide le cache local."""
+    url = os.environ['DATABASE_URL']
+    version = get_data_version()
+
+    def listen():
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(url)
+                conn.autocommit = True
+                with conn.cursor() as c:
+                    c.execute(f"LISTEN {CACHE_NOTIFY_CHANNEL}")
+                # Des écritures ont pu être manquées pendant la (re)connexion
+                version.bump()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        version.bump()
+            except Exception as e:
+                # Toute erreur (connexion perdue, select interrompu...) : on se reconnecte, le thread ne doit pas mourir
+                logging.getLogger('stock_app.cache').warning("Écoute %s interrompue, reconnexion dans 5 s : %s",
+                                                             CACHE_NOTIFY_CHANNEL, e)
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(5)
+
+    thread = threading.Thread(target=listen, name="cache-listener", daemon=True)
+    thread.start()
+    return thread
+
 
 def exec_query(sql, params=None, fetch=False):
     """Exécute une requête SQL."""
-    conn = get_db_connection()
-    if conn is None:
-        return [] if fetch else None
-    
     try:
-        c = conn.cursor()
-        c.execute(sql, params or ())
-        if fetch:
-            result = c.fetchall()
-            conn.close()
-            return result
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(sql, params or ())
+                if fetch:
+                    return c.fetchall()
+                notify_write(c)
+            conn.commit()
+        get_data_version().bump()
     except Exception as e:
-        if conn: conn.close()
         # st.warning(f"Note SQL (peut être une colonne déjà existante): {e}")
         return [] if fetch else None
 
-def init_db_structure():
-    """Crée les tables et colonnes si elles n'existent pas (utilise des requêtes courtes)."""
-    exec_query("""CREATE TABLE IF NOT EXISTS produits (id SERIAL PRIMARY KEY, nom TEXT NOT NULL, prix REAL, quantite INTEGER)""")
-    exec_query("""CREATE TABLE IF NOT EXISTS ventes (id SERIAL PRIMARY KEY, produit_id INTEGER REFERENCES produits(id), quantite INTEGER, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
-    exec_query("""CREATE TABLE IF NOT EXISTS clients (id SERIAL PRIMARY KEY, nom TEXT NOT NULL, adresse TEXT, plafond_credit REAL DEFAULT 0.0, solde_du REAL DEFAULT 0.0)""")
-    exec_query("""CREATE TABLE IF NOT EXISTS paiements (id SERIAL PRIMARY KEY, client_id INTEGER REFERENCES clients(id) NOT NULL, montant REAL NOT NULL, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
 
-    # Ajout des colonnes pour la compatibilité (ignorer l'erreur si elles existent)
-    exec_query("ALTER TABLE ventes ADD COLUMN IF NOT EXISTS client_id INTEGER REFERENCES clients(id)")
-    exec_query("ALTER TABLE ventes ADD COLUMN IF NOT EXISTS montant_credit REAL DEFAULT 0.0")
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _cached_fetch(sql, params, version):
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute(sql, params or ())
+            return c.fetchall()
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _cached_read_sql(sql, params, version):
+    with get_db_connection() as conn:
+        return pd.read_sql(sql, conn, params=params)
+
+
+def cached_query(sql, params=None):
+    """Comme exec_query(fetch=True), mais servi depuis le cache tant qu'aucune écriture n'a eu lieu.
+
+    Une erreur de base (coupure, requête invalide) est remontée telle quelle, comme dans read_sql :
+    un résultat vide ferait croire à un catalogue ou une liste de clients vide.
+    """
+    return _cached_fetch(sql, params, get_data_version().value)
+
+
+def read_sql(sql, params=None):
+    """Charge le résultat d'une requête dans un DataFrame (mis en cache jusqu'à la prochaine écriture)."""
+    return _cached_read_sql(sql, params, get_data_version().value)
+
+
+if not os.environ.get('DATABASE_URL'):
+    st.error("DATABASE_URL non configuré. Vérifiez les secrets de l'application.")
+    st.stop()
+try:
+    get_db_pool()
+except Exception as e:
+    st.error(f"Erreur de connexion DB: {e}")
+    st.stop()
+if CACHE_LISTEN_NOTIFY:
+    start_cache_listener()
+if QUERY_METRICS and METRICS_EXPORT_PATH:
+    start_metrics_export()
+
+# --- MIGRATIONS DU SCHÉMA ---
+
+def selon_dialecte(postgresql=(), sqlite=()):
+    """Étape de migration écrite différemment pour chaque moteur (tuple d'instructions, vide : rien à faire)."""
+    return {'postgresql': postgresql, 'sqlite': sqlite}
+
+
+# Partitions mensuelles créées à l'avance (mois à venir) ; une partition par défaut recueille toute ligne hors plage
+PARTITIONS_AVANCE_MOIS = int(os.environ.get('PARTITIONS_AVANCE_MOIS', '3'))
+
+# Crée les partitions mensuelles manquantes de `parent` entre deux dates. Les lignes du mois déjà tombées
+# dans la partition par défaut y sont déplacées (PostgreSQL refuse sinon de créer la partition).
+CREER_PARTITIONS_MENSUELLES = """
+CREATE OR REPLACE FUNCTION creer_partitions_mensuelles(parent TEXT, debut DATE, fin DATE) RETURNS INTEGER AS $$
+DECLARE
+    debut_mois DATE := date_trunc('month', debut)::date;
+    suivant DATE;
+    nom_partition TEXT;
+    nb INTEGER := 0;
+BEGIN
+    WHILE debut_mois <= fin LOOP
+        suivant := (debut_mois + INTERVAL '1 month')::date;
+        nom_partition := parent || '_' || to_char(debut_mois, 'YYYYMM');
+        IF to_regclass(nom_partition) IS NULL
+           AND NOT EXISTS (SELECT 1 FROM archives a WHERE a.table_nom = parent AND a.mois = debut_mois) THEN
+            EXECUTE format('CREATE TEMP TABLE partition_en_attente (LIKE %I) ON COMMIT DROP', parent);
+            EXECUTE format('WITH d AS (DELETE FROM %I WHERE date >= %L AND date < %L RETURNING *) INSERT INTO partition_en_attente SELECT * FROM d',
+                           parent || '_defaut', debut_mois, suivant);
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', nom_partition, parent, debut_mois, suivant);
+            EXECUTE format('INSERT INTO %I SELECT * FROM partition_en_attente', parent);
+            DROP TABLE partition_en_attente;
+            nb := nb + 1;
+        END IF;
+        debut_mois := suivant;
+    END LOOP;
+    RETURN nb;
+END $$ LANGUAGE plpgsql"""
+
+
+def partitionner_par_mois(table, cles_etrangeres, index):
+    """Instructions (PostgreSQL) qui remplacent `table` par une table partitionnée par mois sur sa colonne date.
+
+    Les données sont recopiées dans la même transaction ; la séquence des id est conservée. Les index et
+    clés étrangères sont recréés sur la table parente, donc sur chaque partition.
+    """
+    ancienne = f"{table}_non_partitionnee"
+    return (
+        f"ALTER TABLE {table} RENAME TO {ancienne}",
+        f"CREATE TABLE {table} (LIKE {ancienne} INCLUDING DEFAULTS) PARTITION BY RANGE (date)",
+        f"ALTER TABLE {table} ALTER COLUMN date SET NOT NULL",
+        f"CREATE TABLE {table}_defaut PARTITION OF {table} DEFAULT",
+        f"""SELECT creer_partitions_mensuelles('{table}', COALESCE((SELECT MIN(date) FROM {ancienne})::date, CURRENT_DATE),
+                                               (CURRENT_DATE + {PARTITIONS_AVANCE_MOIS} * INTERVAL '1 month')::date)""",
+        f"INSERT INTO {table} SELECT * FROM {ancienne}",
+        # La séquence appartient à l'ancienne table : elle serait supprimée avec elle
+        f"""DO $$ BEGIN
+            EXECUTE format('ALTER SEQUENCE %s OWNED BY {table}.id', pg_get_serial_sequence('{ancienne}', 'id'));
+        END $$""",
+        f"DROP TABLE {ancienne}",
+        # La clé de partitionnement fait partie de toute contrainte d'unicité
+        f"ALTER TABLE {table} ADD PRIMARY KEY (id, date)",
+        *(f"ALTER TABLE {table} ADD FOREIGN KEY ({colonne}) REFERENCES {cible}" for colonne, cible in cles_etrangeres),
+        *index,
+    )
+
+
+# Migrations numérotées, appliquées une seule fois et dans l'ordre ; chaque version appliquée est
+# enregistrée dans schema_version. Ne jamais modifier une migration publiée : en ajouter une à la fin.
+# Le SQL est écrit pour PostgreSQL et traduit pour SQLite (traduire_sql), sauf les étapes selon_dialecte().
+MIGRATIONS = [
+    (1, "Tables de base", [
+        """CREATE TABLE IF NOT EXISTS produits (id SERIAL PRIMARY KEY, nom TEXT NOT NULL, prix REAL, quantite INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS ventes (id SERIAL PRIMARY KEY, produit_id INTEGER REFERENCES produits(id), quantite INTEGER, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+        """CREATE TABLE IF NOT EXISTS clients (id SERIAL PRIMARY KEY, nom TEXT NOT NULL, adresse TEXT, plafond_credit REAL DEFAULT 0.0, solde_du REAL DEFAULT 0.0)""",
+        """CREATE TABLE IF NOT EXISTS paiements (id SERIAL PRIMARY KEY, client_id INTEGER REFERENCES clients(id) NOT NULL, montant REAL NOT NULL, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+        # Colonnes ajoutées après coup sur les bases existantes
+        "ALTER TABLE ventes ADD COLUMN IF NOT EXISTS client_id INTEGER REFERENCES clients(id)",
+        "ALTER TABLE ventes ADD COLUMN IF NOT EXISTS montant_credit REAL DEFAULT 0.0",
+    ]),
+    (2, "Index de l'historique paginé et de ses filtres", [
+        "CREATE INDEX IF NOT EXISTS idx_ventes_date_id ON ventes (date, id)",
+        "CREATE INDEX IF NOT EXISTS idx_ventes_client_date ON ventes (client_id, date, id)",
+        "CREATE INDEX IF NOT EXISTS idx_ventes_produit_date ON ventes (produit_id, date, id)",
+        "CREATE INDEX IF NOT EXISTS idx_ventes_credit_date ON ventes (date, id) WHERE montant_credit > 0",
+        "CREATE INDEX IF NOT EXISTS idx_paiements_client_date ON paiements (client_id, date)",
+    ]),
+    (3, "Code-barres et index de recherche des produits", [
+        "ALTER TABLE produits ADD COLUMN IF NOT EXISTS code_barre TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_produits_code_barre ON produits (code_barre)",
+        # Recherche par début de nom, disponible partout ; liste alphabétique quand rien n'est saisi
+        "CREATE INDEX IF NOT EXISTS idx_produits_nom_prefixe ON produits (lower(nom) text_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS idx_produits_nom ON produits (nom)",
+        # Recherche « contient » par trigrammes si l'extension pg_trgm peut être installée (droits suffisants)
+        selon_dialecte(postgresql=("""DO $$
+        BEGIN
+            BEGIN
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            EXCEPTION WHEN OTHERS THEN
+                RAISE NOTICE 'pg_trgm indisponible, recherche par préfixe uniquement : %', SQLERRM;
+            END;
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                CREATE INDEX IF NOT EXISTS idx_produits_nom_trgm ON produits USING gin (nom gin_trgm_ops);
+            END IF;
+        END $$""",)),
+    ]),
+    (4, "Prix figé sur les lignes de vente et agrégats journaliers", [
+        "ALTER TABLE ventes ADD COLUMN IF NOT EXISTS prix_unitaire REAL",
+        "ALTER TABLE ventes ADD COLUMN IF NOT EXISTS mode_paiement TEXT",
+        # Ventes antérieures : le prix courant et le crédit de la première ligne sont la meilleure approximation disponible
+        selon_dialecte(
+            postgresql=("UPDATE ventes v SET prix_unitaire = p.prix FROM produits p WHERE v.produit_id = p.id AND v.prix_unitaire IS NULL",),
+            sqlite=("UPDATE ventes SET prix_unitaire = p.prix FROM produits p WHERE ventes.produit_id = p.id AND ventes.prix_unitaire IS NULL",),
+        ),
+        "UPDATE ventes SET mode_paiement = CASE WHEN montant_credit > 0 THEN 'CRÉDIT' ELSE 'COMPTANT' END WHERE mode_paiement IS NULL",
+        """CREATE TABLE IF NOT EXISTS ventes_daily (
+            jour DATE NOT NULL,
+            produit_id INTEGER NOT NULL REFERENCES produits(id),
+            mode_paiement TEXT NOT NULL,
+            quantite BIGINT NOT NULL DEFAULT 0,
+            chiffre_affaires DOUBLE PRECISION NOT NULL DEFAULT 0,
+            nb_lignes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (jour, produit_id, mode_paiement)
+        )""",
+        """INSERT INTO ventes_daily (jour, produit_id, mode_paiement, quantite, chiffre_affaires, nb_lignes)
+           SELECT date::date, produit_id, mode_paiement, SUM(quantite), SUM(quantite * COALESCE(prix_unitaire, 0)), COUNT(*)
+           FROM ventes
+           WHERE produit_id IS NOT NULL
+           GROUP BY 1, 2, 3
+           ON CONFLICT DO NOTHING""",
+    ]),
+    (5, "Index de l'annuaire clients paginé", [
+        "CREATE INDEX IF NOT EXISTS idx_clients_solde ON clients (solde_du DESC, id)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_nom ON clients (nom, id)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_plafond ON clients (plafond_credit DESC, id)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_nom_prefixe ON clients (lower(nom) text_pattern_ops)",
+    ]),
+    (6, "Journal des mouvements de stock", [
+        """CREATE TABLE IF NOT EXISTS mouvements_stock (
+            id BIGSERIAL PRIMARY KEY,
+            produit_id INTEGER NOT NULL REFERENCES produits(id),
+            delta INTEGER NOT NULL,
+            motif TEXT NOT NULL,
+            date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_mouvements_produit ON mouvements_stock (produit_id, id)",
+        # Journal en ajout seul : toute correction passe par un nouveau mouvement
+        selon_dialecte(
+            postgresql=(
+                """CREATE OR REPLACE FUNCTION mouvements_stock_ajout_seul() RETURNS trigger AS $$
+                BEGIN
+                    RAISE EXCEPTION 'mouvements_stock est un journal en ajout seul';
+                END $$ LANGUAGE plpgsql""",
+                "DROP TRIGGER IF EXISTS mouvements_stock_ajout_seul ON mouvements_stock",
+                """CREATE TRIGGER mouvements_stock_ajout_seul BEFORE UPDATE OR DELETE ON mouvements_stock
+                   FOR EACH ROW EXECUTE FUNCTION mouvements_stock_ajout_seul()""",
+            ),
+            sqlite=(
+                """CREATE TRIGGER IF NOT EXISTS mouvements_stock_sans_modification BEFORE UPDATE ON mouvements_stock
+                   BEGIN SELECT RAISE(ABORT, 'mouvements_stock est un journal en ajout seul'); END""",
+                """CREATE TRIGGER IF NOT EXISTS mouvements_stock_sans_suppression BEFORE DELETE ON mouvements_stock
+                   BEGIN SELECT RAISE(ABORT, 'mouvements_stock est un journal en ajout seul'); END""",
+            ),
+        ),
+        # Solde d'ouverture : à partir d'ici, le stock de chaque produit est la somme de ses mouvements
+        """INSERT INTO mouvements_stock (produit_id, delta, motif)
+           SELECT id, COALESCE(quantite, 0), 'OUVERTURE' FROM produits""",
+    ]),
+    (7, "Clés d'idempotence des écritures différées", [
+        """CREATE TABLE IF NOT EXISTS operations_appliquees (
+            cle UUID PRIMARY KEY,
+            type TEXT NOT NULL,
+            applique_le TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ]),
+    (8, "Partitionnement mensuel des ventes et paiements, mois archivés", [
+        # Mois déplacés dans des fichiers Parquet, et cumul par client de ce qu'ils contenaient
+        """CREATE TABLE IF NOT EXISTS archives (
+            table_nom TEXT NOT NULL,
+            mois DATE NOT NULL,
+            fichier TEXT NOT NULL,
+            nb_lignes BIGINT NOT NULL,
+            archive_le TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (table_nom, mois)
+        )""",
+        """CREATE TABLE IF NOT EXISTS soldes_archives (
+            client_id INTEGER PRIMARY KEY REFERENCES clients(id),
+            credits DOUBLE PRECISION NOT NULL DEFAULT 0,
+            paiements DOUBLE PRECISION NOT NULL DEFAULT 0
+        )""",
+        # SQLite n'a pas de partitionnement : les mois y sont archivés par suppression de plage
+        selon_dialecte(postgresql=(
+            CREER_PARTITIONS_MENSUELLES,
+            *partitionner_par_mois(
+                'ventes', [('produit_id', 'produits(id)'), ('client_id', 'clients(id)')],
+                [
+                    "CREATE INDEX idx_ventes_date_id ON ventes (date, id)",
+                    "CREATE INDEX idx_ventes_client_date ON ventes (client_id, date, id)",
+                    "CREATE INDEX idx_ventes_produit_date ON ventes (produit_id, date, id)",
+                    "CREATE INDEX idx_ventes_credit_date ON ventes (date, id) WHERE montant_credit > 0",
+                ],
+            ),
+            *partitionner_par_mois(
+                'paiements', [('client_id', 'clients(id)')],
+                ["CREATE INDEX idx_paiements_client_date ON paiements (client_id, date)"],
+            ),
+        )),
+    ]),
+    (9, "Plusieurs fichiers d'archive par mois", [
+        # Lignes antidatées arrivées après l'archivage d'un mois : elles sont archivées dans un fichier de plus
+        selon_dialecte(
+            postgresql=(
+                "ALTER TABLE archives DROP CONSTRAINT archives_pkey",
+                "ALTER TABLE archives ADD PRIMARY KEY (table_nom, mois, fichier)",
+            ),
+            # SQLite ne sait pas modifier une clé primaire : la table est reconstruite
+            sqlite=(
+                """CREATE TABLE archives_fichiers (
+                    table_nom TEXT NOT NULL,
+                    mois DATE NOT NULL,
+                    fichier TEXT NOT NULL,
+                    nb_lignes BIGINT NOT NULL,
+                    archive_le TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (table_nom, mois, fichier)
+                )""",
+                "INSERT INTO archives_fichiers SELECT table_nom, mois, fichier, nb_lignes, archive_le FROM archives",
+                "DROP TABLE archives",
+                "ALTER TABLE archives_fichiers RENAME TO archives",
+            ),
+        ),
+    ]),
+    (10, "Dates SQLite à l'heure locale", [
+        # Jusqu'ici SQLite stockait ventes et paiements en UTC (CURRENT_TIMESTAMP) : conversion à l'heure locale,
+        # puis recalcul des agrégats journaliers des jours encore en base (les mois archivés restent tels quels)
+        selon_dialecte(sqlite=(
+            "UPDATE ventes SET date = strftime('%Y-%m-%d %H:%M:%f', date, 'localtime') WHERE date IS NOT NULL",
+            "UPDATE paiements SET date = strftime('%Y-%m-%d %H:%M:%f', date, 'localtime') WHERE date IS NOT NULL",
+            """DELETE FROM ventes_daily
+               WHERE jour >= COALESCE((SELECT MAX(date(mois, '+1 month')) FROM archives WHERE table_nom = 'ventes'), '0001-01-01')""",
+            """INSERT INTO ventes_daily (jour, produit_id, mode_paiement, quantite, chiffre_affaires, nb_lignes)
+               SELECT date(date), produit_id, mode_paiement, SUM(quantite), SUM(quantite * COALESCE(prix_unitaire, 0)), COUNT(*)
+               FROM ventes
+               WHERE produit_id IS NOT NULL
+                 AND date >= COALESCE((SELECT MAX(date(mois, '+1 month')) FROM archives WHERE table_nom = 'ventes'), '0001-01-01')
+               GROUP BY 1, 2, 3""",
+        )),
+    ]),
+]
+
+# Verrou consultatif : un seul processus migre, les autres attendent puis constatent que tout est à jour.
+# SQLite n'en a pas besoin : le DDL y est transactionnel et une migration concurrente échoue sans rien laisser.
+MIGRATION_LOCK_ID = 74930001
+
+
+TABLES_PARTITIONNEES = ('ventes', 'paiements')
+
+
+def creer_partitions_a_venir(cursor):
+    """Partitions du mois courant et des PARTITIONS_AVANCE_MOIS suivants (PostgreSQL)."""
+    for table in TABLES_PARTITIONNEES:
+        cursor.execute(
+            "SELECT creer_partitions_mensuelles(%s, CURRENT_DATE, (CURRENT_DATE + %s * INTERVAL '1 month')::date)",
+            (table, PARTITIONS_AVANCE_MOIS),
+        )
+
+
+@st.cache_resource
+def run_migrations():
+    """Met le schéma à jour une fois par processus serveur ; renvoie la version du schéma."""
+    appliquees = []
+    with get_db_connection() as conn:
+        if DB_DIALECTE == 'postgresql':
+            with conn.cursor() as c:
+                c.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            with conn.cursor() as c:
+                c.execute("""CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+                c.execute("SELECT version FROM schema_version")
+                deja_faites = {r[0] for r in c.fetchall()}
+            conn.commit()
+
+            for version, description, statements in MIGRATIONS:
+                if version in deja_faites:
+                    continue
+                # Chaque migration est atomique : ses instructions et son enregistrement sont validés ensemble
+                with conn.cursor() as c:
+                    for sql in statements:
+                        for instruction in (sql[DB_DIALECTE] if isinstance(sql, dict) else (sql,)):
+                            c.execute(instruction)
+                    c.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+                conn.commit()
+                appliquees.append(version)
+
+            if DB_DIALECTE == 'postgresql':
+                with conn.cursor() as c:
+                    creer_partitions_a_venir(c)
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if DB_DIALECTE == 'postgresql':
+                with conn.cursor() as c:
+                    c.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                conn.commit()
+
+    if appliquees:
+        get_data_version().bump()
+    return max(v for v, _, _ in MIGRATIONS)
 
 
-if 'db_structure_ok' not in st.session_state:
-    init_db_structure()
-    st.session_state['db_structure_ok'] = True
-    # st.info("Structure de la base de données vérifiée et initialisée.")
+try:
+    run_migrations()
+except Exception as e:
+    st.error(f"Échec de la mise à jour du schéma de la base : {e}")
+    st.stop()
 
 
 # --- FONCTIONS DU PANIER (CORRECTION DU CALCUL D'ACCUMULATION) ---
 
+def signaler_panier(cart_key, niveau, texte):
+    """Message d'ajout au panier, affiché par le panneau de vente : un callback (on_change) ne doit rien afficher
+    lui-même, l'élément serait placé hors du fragment."""
+    st.session_state[f"message_{cart_key}"] = (niveau, texte)
+
+
+def afficher_message_panier(cart_key):
+    message = st.session_state.pop(f"message_{cart_key}", None)
+    if message:
+        niveau, texte = message
+        getattr(st, niveau)(texte)
+
+
 def add_to_cart_callback(pid, nom, prix, stock, qty, cart_key):
     if qty <= 0:
-        st.warning("Veuillez entrer une quantité valide.")
+        signaler_panier(cart_key, 'warning', "Veuillez entrer une quantité valide.")
         return
-    if qty > stock:
-        st.error(f"Stock insuffisant. Seulement {stock} disponibles.")
+    deja_au_panier = sum(item['quantite'] for item in st.session_state[cart_key] if item['id'] == pid)
+    if deja_au_panier + qty > stock:
+        signaler_panier(cart_key, 'error', f"Stock insuffisant. Seulement {stock} disponibles ({deja_au_panier} déjà au panier).")
         return
         
     item_total = prix * qty
@@ -84,7 +1132,7 @@ def add_to_cart_callback(pid, nom, prix, stock, qty, cart_key):
         if item['id'] == pid:
             item['quantite'] += qty
             item['total'] += item_total
-            st.success(f"➕ Quantité de {nom} mise à jour dans le panier. Total actuel: {item['total']:.2f} €.")
+            signaler_panier(cart_key, 'success', f"➕ Quantité de {nom} mise à jour dans le panier. Total actuel: {item['total']:.2f} €.")
             return
 
     # Si c'est un nouvel article
@@ -96,13 +1144,1056 @@ def add_to_cart_callback(pid, nom, prix, stock, qty, cart_key):
         'total': item_total,
     })
     
-    st.success(f"➕ {qty} x {nom} (Total: {item_total:.2f} €) ajouté au panier.")
+    signaler_panier(cart_key, 'success', f"➕ {qty} x {nom} (Total: {item_total:.2f} €) ajouté au panier.")
 
 def clear_cart_credit():
     st.session_state['cart_credit'] = []
 def clear_cart_cash():
     st.session_state['cart_cash'] = []
 
+# --- RECHERCHE DE PRODUITS (CAISSE) ---
+
+# Nombre maximum de produits proposés au caissier pour un texte saisi
+RECHERCHE_LIMITE = 20
+
+
+@st.cache_resource
+def has_trigram_search():
+    """Vrai si l'index trigrammes (pg_trgm) est disponible pour la recherche « contient »."""
+    if DB_DIALECTE == 'sqlite':
+        return False
+    rows = cached_query("SELECT 1 FROM pg_indexes WHERE indexname = 'idx_produits_nom_trgm'")
+    return bool(rows)
+
+
+def search_produits(texte, limite=RECHERCHE_LIMITE):
+    """Produits en stock correspondant au texte saisi (les noms qui commencent par le texte d'abord)."""
+    texte = (texte or '').strip()
+    if not texte:
+        return cached_query(
+            """SELECT id, nom, prix, quantite FROM produits WHERE quantite > 0 ORDER BY nom LIMIT %s""",
+            (limite,),
+        )
+    motif = texte.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    if has_trigram_search():
+        condition = "nom ILIKE %(contient)s"
+    else:
+        condition = "lower(nom) LIKE %(prefixe)s"
+    return cached_query(
+        f"""SELECT id, nom, prix, quantite FROM produits
+            WHERE quantite > 0 AND ({condition} OR code_barre = %(code)s)
+            ORDER BY lower(nom) LIKE %(prefixe)s DESC, nom
+            LIMIT %(limite)s""",
+        {'contient': f"%{motif}%", 'prefixe': f"{motif}%", 'code': texte, 'limite': limite},
+    )
+
+
+def rechercher_noms(table, texte, limite=RECHERCHE_LIMITE):
+    """(id, nom) des premiers clients ou produits (`table`) dont le nom commence par le texte saisi."""
+    motif = (texte or '').strip().lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return cached_query(
+        f"SELECT id, nom FROM {table} WHERE lower(nom) LIKE %s ORDER BY nom LIMIT %s",
+        (f"{motif}%", limite),
+    )
+
+
+def scan_code_barre_callback(cart_key, widget_key):
+    """Un code-barres scanné (validé par Entrée) ajoute directement une unité au panier."""
+    code = st.session_state[widget_key].strip()
+    st.session_state[widget_key] = ""
+    if not code:
+        return
+    rows = cached_query("SELECT id, nom, prix, quantite FROM produits WHERE code_barre = %s", (code,))
+    if not rows:
+        signaler_panier(cart_key, 'error', f"Aucun produit pour le code-barres {code}.")
+        return
+    pid, nom, prix, stock = rows[0]
+    add_to_cart_callback(pid, nom, prix, stock, 1, cart_key)
+
+
+# --- ENREGISTREMENT D'UNE VENTE (TRANSACTION UNIQUE) ---
+
+class CheckoutError(Exception):
+    """Vente refusée (plafond de crédit, stock insuffisant...) : rien n'a été enregistré."""
+
+
+# Nombre d'essais d'une vente interrompue par un interblocage entre caisses (rare, rejouée sans risque)
+CHECKOUT_TENTATIVES = 3
+
+
+def checkout(cart, client_id, is_credit_sale):
+    """Enregistre tout le panier en une transaction, avec un nombre de requêtes indépendant de sa taille.
+
+    Stock et crédit sont modifiés par des mises à jour conditionnelles atomiques : plusieurs caisses
+    peuvent vendre en parallèle sans verrou global, sans survente ni dépassement de plafond.
+    """
+    for tentative in range(1, CHECKOUT_TENTATIVES + 1):
+        try:
+            with db_transaction() as conn:
+                with conn.cursor() as c:
+                    total_panier = apply_checkout(c, cart, client_id, is_credit_sale)
+                    notify_write(c)
+            get_data_version().bump()
+            return total_panier
+        except (psycopg2.errors.DeadlockDetected, psycopg2.errors.SerializationFailure):
+            if tentative == CHECKOUT_TENTATIVES:
+                raise
+
+
+def apply_checkout(c, cart, client_id, is_credit_sale, date_vente=None):
+    """Instructions d'une vente, sur le curseur d'une transaction ouverte par l'appelant ; renvoie le total.
+
+    date_vente (datetime avec fuseau) date une vente enregistrée en différé ; par défaut, l'heure du serveur SQL.
+    """
+    total_panier = float(sum(item['total'] for item in cart))
+    montant_credit = 0.0
+
+    if is_credit_sale:
+        # Le plafond est vérifié sur le solde réel au moment de l'écriture, pas sur celui affiché
+        c.execute(
+            """UPDATE clients SET solde_du = solde_du + %(montant)s
+               WHERE id = %(cid)s AND solde_du + %(montant)s <= plafond_credit
+               RETURNING solde_du""",
+            {'montant': total_panier, 'cid': client_id},
+        )
+        if c.fetchone() is None:
+            c.execute("SELECT solde_du, plafond_credit FROM clients WHERE id = %s", (client_id,))
+            row = c.fetchone()
+            if row is None:
+                raise CheckoutError("Client introuvable.")
+            solde_du, plafond = row
+            raise CheckoutError(f"CRÉDIT REFUSÉ ! Le solde de {solde_du + total_panier:.2f} € dépasse le plafond de {plafond:.2f} €.")
+        montant_credit = total_panier
+
+    # Décrément de tout le stock en une requête ; une ligne sans stock suffisant n'est pas modifiée.
+    # Chaque décrément est inscrit dans le journal des mouvements par la même instruction.
+    lignes_stock = sorted((int(item['id']), int(item['quantite'])) for item in cart)
+    if DB_DIALECTE == 'sqlite':
+        mis_a_jour = _decrementer_stock_sqlite(c, lignes_stock)
+    else:
+        mis_a_jour = execute_values(
+            c,
+            """WITH v(id, qte) AS (VALUES %s),
+               verrou AS (
+                   -- Lignes verrouillées dans l'ordre des id : deux caisses ne peuvent pas s'interbloquer
+                   SELECT p.id FROM produits p JOIN v ON v.id = p.id ORDER BY p.id FOR UPDATE OF p
+               ), maj AS (
+                   UPDATE produits AS p SET quantite = p.quantite - v.qte
+                   FROM v JOIN verrou ON verrou.id = v.id
+                   WHERE p.id = v.id AND p.quantite >= v.qte
+                   RETURNING p.id, v.qte
+               )
+               INSERT INTO mouvements_stock (produit_id, delta, motif)
+               SELECT id, -qte, 'VENTE' FROM maj
+               RETURNING produit_id""",
+            lignes_stock, page_size=len(lignes_stock), fetch=True,
+        )
+    if len(mis_a_jour) != len(lignes_stock):
+        ok = {r[0] for r in mis_a_jour}
+        manquants = [item['nom'] for item in cart if item['id'] not in ok]
+        raise CheckoutError(f"Stock insuffisant pour : {', '.join(manquants)}.")
+
+    # Le montant total du crédit est enregistré uniquement sur le premier article
+    # pour que l'historique puisse le filtrer facilement. Le prix unitaire est figé au moment de la vente.
+    mode_paiement = 'CRÉDIT' if is_credit_sale else 'COMPTANT'
+    lignes_vente = [
+        (item['id'], item['quantite'], client_id, montant_credit if i == 0 else 0.0, item['prix_u'], mode_paiement, date_vente)
+        for i, item in enumerate(cart)
+    ]
+    if DB_DIALECTE == 'sqlite':
+        _inserer_ventes_sqlite(c, lignes_vente)
+    else:
+        # Lignes de vente et agrégats journaliers dans la même instruction (même transaction)
+        execute_values(
+            c,
+            """WITH lignes AS (
+                   INSERT INTO ventes (produit_id, quantite, client_id, montant_credit, prix_unitaire, mode_paiement, date)
+                   VALUES %s
+                   RETURNING date::date AS jour, produit_id, mode_paiement, quantite, quantite * prix_unitaire AS ca
+               )
+               INSERT INTO ventes_daily (jour, produit_id, mode_paiement, quantite, chiffre_affaires, nb_lignes)
+               SELECT jour, produit_id, mode_paiement, SUM(quantite), SUM(ca), COUNT(*)
+               FROM lignes
+               GROUP BY jour, produit_id, mode_paiement
+               ORDER BY produit_id
+               ON CONFLICT (jour, produit_id, mode_paiement) DO UPDATE SET
+                   quantite = ventes_daily.quantite + EXCLUDED.quantite,
+                   chiffre_affaires = ventes_daily.chiffre_affaires + EXCLUDED.chiffre_affaires,
+                   nb_lignes = ventes_daily.nb_lignes + EXCLUDED.nb_lignes""",
+            lignes_vente, page_size=len(lignes_vente),
+            template="(%s, %s, %s, %s, %s, %s, COALESCE(%s::timestamptz, CURRENT_TIMESTAMP))",
+        )
+    return total_panier
+
+
+def _decrementer_stock_sqlite(c, lignes_stock):
+    """Variante SQLite du décrément de stock (pas d'écriture dans un WITH) : une instruction par ligne, en local.
+
+    BEGIN IMMEDIATE donne à la transaction l'exclusivité en écriture : le contrôle du stock et le décrément
+    ne peuvent pas être entrelacés avec une autre caisse.
+    """
+    mis_a_jour = []
+    for pid, qte in lignes_stock:
+        c.execute("UPDATE produits SET quantite = quantite - %s WHERE id = %s AND quantite >= %s RETURNING id",
+                  (qte, pid, qte))
+        if c.fetchone() is not None:
+            mis_a_jour.append((pid, qte))
+    c.executemany("INSERT INTO mouvements_stock (produit_id, delta, motif) VALUES (%s, %s, 'VENTE')",
+                  [(pid, -qte) for pid, qte in mis_a_jour])
+    return mis_a_jour
+
+
+def _inserer_ventes_sqlite(c, lignes_vente):
+    """Variante SQLite de l'insertion des lignes de vente et de la mise à jour de ventes_daily."""
+    c.executemany(
+        """INSERT INTO ventes (produit_id, quantite, client_id, montant_credit, prix_unitaire, mode_paiement, date)
+           VALUES (%s, %s, %s, %s, %s, %s, COALESCE(%s::timestamptz, CURRENT_TIMESTAMP))""",
+        lignes_vente,
+    )
+    c.executemany(
+        """INSERT INTO ventes_daily (jour, produit_id, mode_paiement, quantite, chiffre_affaires, nb_lignes)
+           VALUES (date(COALESCE(%s::timestamptz, CURRENT_TIMESTAMP)), %s, %s, %s, %s, 1)
+           ON CONFLICT (jour, produit_id, mode_paiement) DO UPDATE SET
+               quantite = ventes_daily.quantite + excluded.quantite,
+               chiffre_affaires = ventes_daily.chiffre_affaires + excluded.chiffre_affaires,
+               nb_lignes = ventes_daily.nb_lignes + excluded.nb_lignes""",
+        [(date_vente, pid, mode, qte, qte * prix) for pid, qte, _, _, prix, mode, date_vente in lignes_vente],
+    )
+
+
+# --- ENREGISTREMENT D'UN PAIEMENT ---
+
+class PaiementError(Exception):
+    """Paiement refusé (montant supérieur à la dette...) : rien n'a été enregistré."""
+
+
+def enregistrer_paiement(client_id, montant):
+    """Diminue la dette et enregistre le paiement dans une seule transaction ; renvoie le nouveau solde dû."""
+    with db_transaction() as conn:
+        with conn.cursor() as c:
+            nouveau_solde = apply_paiement(c, client_id, montant)
+            notify_write(c)
+    get_data_version().bump()
+    return nouveau_solde
+
+
+def apply_paiement(c, client_id, montant, date_paiement=None):
+    """Instructions d'un paiement, sur le curseur d'une transaction ouverte par l'appelant ; renvoie le nouveau solde."""
+    # Conditionnel : deux caisses qui encaissent le même client ne peuvent pas rendre le solde négatif
+    c.execute(
+        """UPDATE clients SET solde_du = solde_du - %(montant)s
+           WHERE id = %(cid)s AND solde_du >= %(montant)s
+           RETURNING solde_du""",
+        {'montant': montant, 'cid': client_id},
+    )
+    row = c.fetchone()
+    if row is None:
+        raise PaiementError("Le montant dépasse la dette actuelle du client (déjà réglée sur une autre caisse ?).")
+    c.execute(
+        "INSERT INTO paiements (client_id, montant, date) VALUES (%s, %s, COALESCE(%s::timestamptz, CURRENT_TIMESTAMP))",
+        (client_id, montant, date_paiement),
+    )
+    return row[0]
+
+
+# --- ÉCRITURES DIFFÉRÉES (JOURNAL LOCAL + SYNCHRONISATION) ---
+
+# Ventes et paiements sont d'abord inscrits dans un journal SQLite local, puis appliqués à PostgreSQL
+# par un thread de fond : la caisse confirme sans attendre le réseau et rien n'est perdu pendant une coupure.
+# Désactivé par défaut : la vente est confirmée avant le contrôle du stock et du plafond par la base,
+# une opération refusée à la synchronisation n'apparaît que dans la barre latérale
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_JOURNAL = os.environ.get('WRITE_BEHIND_JOURNAL', 'journal_ecritures.sqlite3')
+# Nombre max d'opérations appliquées par transaction, et délai max (s) entre deux nouvelles tentatives
+WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', '50'))
+WRITE_BEHIND_BACKOFF_MAX = float(os.environ.get('WRITE_BEHIND_BACKOFF_MAX', '60'))
+
+
+class WriteBehindJournal:
+    """Journal durable des opérations à appliquer, partagé par les sessions du processus."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # FULL : chaque opération confirmée au caissier est sur disque
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS operations (
+            cle TEXT PRIMARY KEY,
+            type TEXT NOT NULL,
+            donnees TEXT NOT NULL,
+            statut TEXT NOT NULL DEFAULT 'EN_ATTENTE',
+            tentatives INTEGER NOT NULL DEFAULT 0,
+            erreur TEXT,
+            cree_le REAL NOT NULL,
+            prochain_essai REAL NOT NULL DEFAULT 0
+        )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_operations_statut ON operations (statut, prochain_essai)")
+        self.reveil = threading.Event()
+
+    def ajouter(self, type_operation, donnees):
+        cle = str(uuid.uuid4())
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO operations (cle, type, donnees, cree_le) VALUES (?, ?, ?, ?)",
+                (cle, type_operation, json.dumps(donnees), time.time()),
+            )
+        self.reveil.set()
+        return cle
+
+    def a_appliquer(self, limite):
+        with self._lock:
+            return self._conn.execute(
+                """SELECT cle, type, donnees, tentatives FROM operations
+                   WHERE statut = 'EN_ATTENTE' AND prochain_essai <= ? ORDER BY cree_le LIMIT ?""",
+                (time.time(), limite),
+            ).fetchall()
+
+    def marquer(self, appliquees, rejetees):
+        """appliquees : liste de clés ; rejetees : liste de (clé, message)."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("UPDATE operations SET statut = 'APPLIQUEE', erreur = NULL WHERE cle = ?",
+                                   [(cle,) for cle in appliquees])
+            self._conn.executemany("UPDATE operations SET statut = 'REJETEE', erreur = ? WHERE cle = ?",
+                                   [(message, cle) for cle, message in rejetees])
+            self._conn.execute("COMMIT")
+
+    def reporter(self, operations, erreur):
+        """Base injoignable ou transaction interrompue : nouvel essai plus tard (attente exponentielle)."""
+        maintenant = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE operations SET tentatives = tentatives + 1, erreur = ?, prochain_essai = ? WHERE cle = ?",
+                [(erreur, maintenant + min(WRITE_BEHIND_BACKOFF_MAX, 2 ** tentatives), cle)
+                 for cle, _, _, tentatives in operations],
+            )
+
+    def credit_en_attente(self, client_id):
+        """Montant des ventes à crédit de ce client encore dans le journal (pas encore dans solde_du)."""
+        with self._lock:
+            return self._conn.execute(
+                """SELECT COALESCE(SUM(json_extract(ligne.value, '$.total')), 0)
+                   FROM operations, json_each(operations.donnees, '$.cart') AS ligne
+                   WHERE operations.statut = 'EN_ATTENTE' AND operations.type = 'vente'
+                     AND json_extract(operations.donnees, '$.is_credit_sale')
+                     AND json_extract(operations.donnees, '$.client_id') = ?""",
+                (client_id,),
+            ).fetchone()[0]
+
+    def paiement_en_attente(self, client_id):
+        """Montant des paiements de ce client encore dans le journal (pas encore déduits de solde_du)."""
+        with self._lock:
+            return self._conn.execute(
+                """SELECT COALESCE(SUM(json_extract(donnees, '$.montant')), 0) FROM operations
+                   WHERE statut = 'EN_ATTENTE' AND type = 'paiement' AND json_extract(donnees, '$.client_id') = ?""",
+                (client_id,),
+            ).fetchone()[0]
+
+    def etat(self):
+        with self._lock:
+            compte = dict(self._conn.execute("SELECT statut, COUNT(*) FROM operations GROUP BY statut").fetchall())
+            rejets = self._conn.execute(
+                "SELECT cree_le, type, donnees, erreur FROM operations WHERE statut = 'REJETEE' ORDER BY cree_le DESC LIMIT 20"
+            ).fetchall()
+        return compte, rejets
+
+
+def _appliquer_operation(c, type_operation, donnees):
+    if type_operation == 'vente':
+        apply_checkout(c, donnees['cart'], donnees['client_id'], donnees['is_credit_sale'], donnees['date'])
+    elif type_operation == 'paiement':
+        apply_paiement(c, donnees['client_id'], donnees['montant'], donnees['date'])
+    else:
+        raise ValueError(f"Type d'opération inconnu : {type_operation}")
+
+
+# Erreurs propres à une opération (refus métier, contrainte violée, donnée invalide) : la rejouer
+# échouerait à nouveau. Les autres (connexion, conflit de sérialisation...) sont retentées plus tard.
+ERREURS_DEFINITIVES = (
+    CheckoutError, PaiementError, ValueError, KeyError, TypeError,
+    psycopg2.IntegrityError, psycopg2.DataError, sqlite3.IntegrityError, sqlite3.DataError,
+)
+
+
+def flush_write_behind(journal):
+    """Applique un lot d'opérations en attente dans une seule transaction ; renvoie le nombre traité.
+
+    Chaque opération a son point de sauvegarde : une opération refusée (stock, plafond, client
+    inconnu...) est marquée rejetée sans annuler les autres. La clé d'idempotence, enregistrée dans la même transaction,
+    empêche d'appliquer deux fois une opération si la confirmation locale a été perdue.
+    """
+    operations = journal.a_appliquer(WRITE_BEHIND_BATCH)
+    if not operations:
+        return 0
+    appliquees, rejetees = [], []
+    try:
+        with db_transaction() as conn:
+            with conn.cursor() as c:
+                for cle, type_operation, donnees, _ in operations:
+                    c.execute("SAVEPOINT operation")
+                    c.execute("INSERT INTO operations_appliquees (cle, type) VALUES (%s, %s) ON CONFLICT DO NOTHING RETURNING cle",
+                              (cle, type_operation))
+                    if c.fetchone() is not None:
+                        try:
+                            _appliquer_operation(c, type_operation, json.loads(donnees))
+                        except ERREURS_DEFINITIVES as e:
+                            c.execute("ROLLBACK TO SAVEPOINT operation")
+                            rejetees.append((cle, str(e)))
+                            continue
+                    c.execute("RELEASE SAVEPOINT operation")
+                    appliquees.append(cle)
+                notify_write(c)
+    except Exception as e:
+        journal.reporter(operations, str(e))
+        return 0
+    journal.marquer(appliquees, rejetees)
+    get_data_version().bump()
+    return len(operations)
+
+
+@st.cache_resource
+def get_write_behind():
+    """Journal local et thread de synchronisation, uniques pour le processus."""
+    journal = WriteBehindJournal(WRITE_BEHIND_JOURNAL)
+
+    def synchroniser():
+        while True:
+            journal.reveil.wait(timeout=1)
+            journal.reveil.clear()
+            # Vide la file par lots tant qu'il reste des opérations prêtes
+            while flush_write_behind(journal):
+                pass
+
+    threading.Thread(target=synchroniser, name="write-behind", daemon=True).start()
+    return journal
+
+
+def _maintenant_utc():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def soumettre_vente(cart, client_id, is_credit_sale):
+    """Enregistre la vente dans le journal local (ou directement si l'écriture différée est désactivée)."""
+    if not WRITE_BEHIND:
+        return checkout(cart, client_id, is_credit_sale)
+    panier = [
+        {'id': int(item['id']), 'nom': item['nom'], 'prix_u': float(item['prix_u']),
+         'quantite': int(item['quantite']), 'total': float(item['total'])}
+        for item in cart
+    ]
+    get_write_behind().ajouter('vente', {
+        'cart': panier, 'client_id': client_id and int(client_id), 'is_credit_sale': is_credit_sale,
+        'date': _maintenant_utc(),
+    })
+    return float(sum(item['total'] for item in cart))
+
+
+# Contrôle puis inscription d'un paiement différé sans qu'une autre session du processus s'intercale
+_VERROU_PAIEMENTS = threading.Lock()
+
+
+def soumettre_paiement(client_id, montant, solde_du=None):
+    """Enregistre le paiement dans le journal local (ou directement si l'écriture différée est désactivée).
+
+    En écriture différée, `solde_du` (solde connu de la caisse) moins les paiements encore en attente borne
+    le montant : la même dette ne peut pas être encaissée deux fois avant la synchronisation.
+    """
+    if not WRITE_BEHIND:
+        return enregistrer_paiement(client_id, montant)
+    journal = get_write_behind()
+    with _VERROU_PAIEMENTS:
+        if solde_du is not None and montant > solde_du - journal.paiement_en_attente(client_id) + 0.005:
+            raise PaiementError("Le montant dépasse la dette restante (des paiements sont en attente de synchronisation).")
+        journal.ajouter('paiement', {'client_id': int(client_id), 'montant': float(montant), 'date': _maintenant_utc()})
+    return None
+
+
+# --- IMPORT / EXPORT EN MASSE (COPY) ---
+
+class ImportProduitsError(ValueError):
+    """Fichier d'import illisible (en-tête manquant, CSV mal formé...) : rien n'a été importé."""
+
+
+IMPORT_COLONNES = ('nom', 'prix', 'quantite')
+IMPORT_COLONNES_OPTIONNELLES = ('code_barre',)
+
+# Une ligne est importable si le nom est renseigné, le prix décimal (point ou virgule) et la quantité entière positive
+IMPORT_LIGNE_VALIDE = """
+    COALESCE(btrim(nom), '') <> ''
+    AND COALESCE(btrim(prix), '') ~ '^[0-9]{1,12}([.,][0-9]+)?$'
+    AND COALESCE(btrim(quantite), '') ~ '^[0-9]{1,9}$'
+"""
+# Mêmes règles côté Python, pour le chemin SQLite
+_IMPORT_PRIX_VALIDE = re.compile(r'[0-9]{1,12}([.,][0-9]+)?')
+_IMPORT_QUANTITE_VALIDE = re.compile(r'[0-9]{1,9}')
+
+
+def import_produits_csv(fichier, ajouter_quantites=False):
+    """Importe un catalogue CSV (nom, prix, quantite[, code_barre]) en une transaction via une table de travail.
+
+    Les produits existants (même nom) sont mis à jour, les autres créés. Renvoie
+    (nb_mis_a_jour, nb_crees, df_rejets) où df_rejets liste les lignes invalides.
+    """
+    entete = fichier.readline().decode('utf-8-sig').strip()
+    separateur = ';' if entete.count(';') > entete.count(',') else ','
+    colonnes = [c.strip().lower() for c in entete.split(separateur)]
+    if not set(IMPORT_COLONNES) <= set(colonnes) <= set(IMPORT_COLONNES + IMPORT_COLONNES_OPTIONNELLES) or len(set(colonnes)) != len(colonnes):
+        raise ImportProduitsError(f"En-tête attendu : {separateur.join(IMPORT_COLONNES)} (reçu : {entete or 'vide'}).")
+
+    try:
+        with db_transaction() as conn:
+            with conn.cursor() as c:
+                if DB_DIALECTE == 'sqlite':
+                    resultat = _import_produits_sqlite(c, fichier, colonnes, separateur, ajouter_quantites)
+                else:
+                    resultat = _import_produits_postgres(c, fichier, colonnes, separateur, ajouter_quantites)
+                notify_write(c)
+    except psycopg2.DataError as e:
+        # CSV mal formé (guillemets, nombre de colonnes...) : COPY échoue en entier
+        raise ImportProduitsError(str(e).strip()) from e
+    except psycopg2.IntegrityError as e:
+        raise ImportProduitsError(f"Code-barres déjà attribué à un autre produit : {e.diag.message_detail or e}") from e
+    except sqlite3.IntegrityError as e:
+        raise ImportProduitsError(f"Code-barres déjà attribué à un autre produit : {e}") from e
+
+    get_data_version().bump()
+    return resultat
+
+
+def _import_produits_postgres(c, fichier, colonnes, separateur, ajouter_quantites):
+    c.execute("""CREATE TEMP TABLE import_produits (ligne SERIAL, nom TEXT, prix TEXT, quantite TEXT, code_barre TEXT) ON COMMIT DROP""")
+    # Le reste du fichier est transmis au serveur par blocs, sans être chargé en mémoire
+    c.copy_expert(
+        f"COPY import_produits ({', '.join(colonnes)}) FROM STDIN "
+        f"WITH (FORMAT csv, DELIMITER '{separateur}', ENCODING 'UTF8')",
+        fichier,
+    )
+
+    c.execute(f"""
+        SELECT ligne + 1 AS "Ligne", nom AS "Nom", prix AS "Prix", quantite AS "Quantité"
+        FROM import_produits WHERE NOT ({IMPORT_LIGNE_VALIDE}) IS TRUE ORDER BY ligne
+    """)
+    df_rejets = pd.DataFrame(c.fetchall(), columns=[d[0] for d in c.description])
+
+    # Mise à jour et création en une seule instruction ; pour un nom en double, la dernière ligne l'emporte
+    c.execute(f"""
+        WITH valides AS (
+            SELECT DISTINCT ON (btrim(nom))
+                   btrim(nom) AS nom,
+                   replace(btrim(prix), ',', '.')::real AS prix,
+                   btrim(quantite)::integer AS quantite,
+                   NULLIF(btrim(code_barre), '') AS code_barre
+            FROM import_produits
+            WHERE {IMPORT_LIGNE_VALIDE}
+            ORDER BY btrim(nom), ligne DESC
+        ), maj AS (
+            UPDATE produits AS p
+            SET prix = v.prix,
+                quantite = CASE WHEN %(ajouter)s THEN COALESCE(p.quantite, 0) + v.quantite ELSE v.quantite END,
+                code_barre = COALESCE(v.code_barre, p.code_barre)
+            FROM valides v, produits AS avant
+            WHERE p.nom = v.nom AND avant.id = p.id
+            RETURNING p.id, p.nom, p.quantite - COALESCE(avant.quantite, 0) AS delta
+        ), crees AS (
+            INSERT INTO produits (nom, prix, quantite, code_barre)
+            SELECT v.nom, v.prix, v.quantite, v.code_barre FROM valides v
+            WHERE NOT EXISTS (SELECT 1 FROM produits p WHERE p.nom = v.nom)
+            RETURNING id, quantite
+        ), mouvements AS (
+            INSERT INTO mouvements_stock (produit_id, delta, motif)
+            SELECT id, delta, 'IMPORT' FROM maj WHERE delta <> 0
+            UNION ALL
+            SELECT id, quantite, 'CRÉATION' FROM crees
+        )
+        SELECT (SELECT COUNT(DISTINCT nom) FROM maj), (SELECT COUNT(*) FROM crees)
+    """, {'ajouter': ajouter_quantites})
+    nb_maj, nb_crees = c.fetchone()
+    return nb_maj, nb_crees, df_rejets
+
+
+def _import_produits_sqlite(c, fichier, colonnes, separateur, ajouter_quantites):
+    """Variante SQLite : le CSV est lu et validé en Python (mêmes règles que IMPORT_LIGNE_VALIDE), puis appliqué
+    par une table de travail temporaire et des instructions simples, dans la même transaction."""
+    texte = io.TextIOWrapper(fichier, encoding='utf-8', newline='')
+    rejets, valides = [], {}
+    try:
+        for numero, ligne in enumerate(csv.reader(texte, delimiter=separateur), start=2):
+            if not ligne:
+                continue
+            if len(ligne) != len(colonnes):
+                raise ImportProduitsError(f"Ligne {numero} : {len(ligne)} colonnes au lieu de {len(colonnes)}.")
+            champs = {col: val.strip() for col, val in zip(colonnes, ligne)}
+            nom, prix, quantite = champs['nom'], champs['prix'], champs['quantite']
+            if nom and _IMPORT_PRIX_VALIDE.fullmatch(prix) and _IMPORT_QUANTITE_VALIDE.fullmatch(quantite):
+                # Pour un nom en double, la dernière ligne l'emporte
+                valides[nom] = (nom, float(prix.replace(',', '.')), int(quantite), champs.get('code_barre') or None)
+            else:
+                rejets.append((numero, nom, prix, quantite))
+    except csv.Error as e:
+        raise ImportProduitsError(str(e)) from e
+    except UnicodeDecodeError as e:
+        # Ex. CSV « ; » enregistré par Excel en Windows-1252 : refusé comme COPY ... ENCODING 'UTF8' sous PostgreSQL
+        raise ImportProduitsError(f"Le fichier doit être encodé en UTF-8 ({e}).") from e
+    finally:
+        texte.detach()
+    df_rejets = pd.DataFrame(rejets, columns=["Ligne", "Nom", "Prix", "Quantité"])
+
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS import_produits (nom TEXT PRIMARY KEY, prix REAL, quantite INTEGER, code_barre TEXT)")
+    c.execute("DELETE FROM import_produits")
+    c.executemany("INSERT INTO import_produits VALUES (%s, %s, %s, %s)", list(valides.values()))
+    params = {'ajouter': ajouter_quantites}
+    c.execute("SELECT COUNT(*) FROM import_produits v WHERE EXISTS (SELECT 1 FROM produits p WHERE p.nom = v.nom)")
+    nb_maj = c.fetchone()[0]
+    # Mouvements calculés avant la mise à jour, à partir de l'ancien stock
+    c.execute("""
+        INSERT INTO mouvements_stock (produit_id, delta, motif)
+        SELECT id, delta, 'IMPORT' FROM (
+            SELECT p.id, CASE WHEN %(ajouter)s THEN v.quantite ELSE v.quantite - COALESCE(p.quantite, 0) END AS delta
+            FROM produits p JOIN import_produits v ON v.nom = p.nom
+        ) WHERE delta <> 0
+    """, params)
+    c.execute("""
+        UPDATE produits
+        SET prix = v.prix,
+            quantite = CASE WHEN %(ajouter)s THEN COALESCE(produits.quantite, 0) + v.quantite ELSE v.quantite END,
+            code_barre = COALESCE(v.code_barre, produits.code_barre)
+        FROM import_produits v
+        WHERE produits.nom = v.nom
+    """, params)
+    c.execute("""
+        INSERT INTO produits (nom, prix, quantite, code_barre)
+        SELECT v.nom, v.prix, v.quantite, v.code_barre FROM import_produits v
+        WHERE NOT EXISTS (SELECT 1 FROM produits p WHERE p.nom = v.nom)
+        RETURNING id, quantite
+    """)
+    crees = c.fetchall()
+    c.executemany("INSERT INTO mouvements_stock (produit_id, delta, motif) VALUES (%s, %s, 'CRÉATION')", crees)
+    c.execute("DELETE FROM import_produits")
+    return nb_maj, len(crees), df_rejets
+
+
+EXPORTS = {
+    "Stock (produits)": ("stock", "SELECT id, nom, prix, quantite, code_barre FROM produits ORDER BY id"),
+    "Ventes": ("ventes", "SELECT id, date, produit_id, quantite, client_id, montant_credit, prix_unitaire, mode_paiement "
+               "FROM ventes ORDER BY id"),
+    "Paiements": ("paiements", "SELECT id, date, client_id, montant FROM paiements ORDER BY id"),
+}
+
+
+def export_table(sql, format_fichier='csv', types_colonnes=None):
+    """Exporte une requête via COPY ... TO STDOUT dans un fichier temporaire (jamais de DataFrame complet).
+
+    Le Parquet est écrit par lots à partir du flux CSV, avec les types de `types_colonnes` ({colonne: type
+    pyarrow}) plutôt que ceux déduits du premier lot. Le fichier renvoyé est positionné au début et supprimé
+    à sa fermeture.
+    """
+    flux_csv = tempfile.TemporaryFile()
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            if DB_DIALECTE == 'sqlite':
+                # Pas de COPY : les lignes sont écrites au fil du curseur
+                c.execute(sql)
+                texte = io.TextIOWrapper(flux_csv, encoding='utf-8', newline='')
+                writer = csv.writer(texte, lineterminator='\n')
+                writer.writerow([d[0] for d in c.description])
+                while lot := c.fetchmany(5000):
+                    writer.writerows(lot)
+                texte.flush()
+                texte.detach()
+            else:
+                c.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)", flux_csv)
+    flux_csv.seek(0)
+    if format_fichier == 'csv':
+        return flux_csv
+
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    conversion = pa_csv.ConvertOptions(column_types={col: pa.type_for_alias(t) for col, t in (types_colonnes or {}).items()})
+    fichier_parquet = tempfile.TemporaryFile()
+    with flux_csv:
+        lecteur = pa_csv.open_csv(flux_csv, convert_options=conversion)
+        with pq.ParquetWriter(fichier_parquet, lecteur.schema, compression='zstd') as writer:
+            for lot in lecteur:
+                writer.write_batch(lot)
+    fichier_parquet.seek(0)
+    return fichier_parquet
+
+
+# --- ARCHIVAGE DES MOIS ANCIENS (PARQUET) ---
+
+# Les mois de ventes et paiements plus anciens que la rétention quittent la base pour des fichiers Parquet
+# compressés ; historique, relevés et exports les relisent à la demande. 0 : pas d'archivage.
+ARCHIVE_RETENTION_MOIS = int(os.environ.get('ARCHIVE_RETENTION_MOIS', '0'))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archives')
+# Intervalle (s) entre deux passages du job mensuel (partitions à venir, puis archivage)
+ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL', '86400'))
+# Les mois archivés comptent dans la dernière tranche d'ancienneté des créances (plus de 90 jours)
+ARCHIVE_RETENTION_MIN = 3
+ARCHIVE_LOCK_ID = 74930002
+# Colonnes archivées de chaque table et leur type Parquet
+ARCHIVE_COLONNES = {
+    'ventes': {'id': 'int64', 'produit_id': 'int64', 'quantite': 'int64', 'date': 'timestamp[us]', 'client_id': 'int64',
+               'montant_credit': 'float64', 'prix_unitaire': 'float64', 'mode_paiement': 'string'},
+    'paiements': {'id': 'int64', 'client_id': 'int64', 'montant': 'float64', 'date': 'timestamp[us]'},
+}
+# Colonne cumulée par client dans soldes_archives au moment de l'archivage
+ARCHIVE_SOLDES = {'ventes': ('credits', 'montant_credit'), 'paiements': ('paiements', 'montant')}
+
+
+class ArchiveError(Exception):
+    """Archivage d'un mois abandonné : la base est inchangée, le fichier sera réécrit au prochain passage."""
+
+
+def debut_mois(jour, decalage=0):
+    """Premier jour du mois de `jour`, décalé de `decalage` mois."""
+    mois = jour.year * 12 + jour.month - 1 + decalage
+    return datetime.date(mois // 12, mois % 12 + 1, 1)
+
+
+def mois_en_base(cursor, table, limite):
+    """Mois (premier jour) de `table` antérieurs à `limite` encore présents en base, du plus ancien au plus récent."""
+    if DB_DIALECTE == 'postgresql':
+        # Une partition par mois : le catalogue suffit, sans lire les données
+        cursor.execute("""SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                          WHERE i.inhparent = %s::regclass""", (table,))
+        mois = [datetime.date(int(nom[-6:-2]), int(nom[-2:]), 1) for (nom,) in cursor.fetchall() if nom[-6:].isdigit()]
+    else:
+        cursor.execute(f"SELECT DISTINCT substr(date, 1, 7) FROM {table} WHERE date < %s", (limite,))
+        mois = [datetime.date(int(m[:4]), int(m[5:7]), 1) for (m,) in cursor.fetchall()]
+    return sorted(m for m in mois if m < limite)
+
+
+def fichier_archive_libre(table, mois):
+    """Chemin du prochain fichier d'archive du mois : AAAA-MM.parquet, puis AAAA-MM.2.parquet, etc.
+
+    Un mois déjà archivé peut recevoir des lignes antidatées (rejeu du journal, correction manuelle) :
+    elles vont dans un fichier de plus, jamais à la place d'un fichier inscrit dans `archives`.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT fichier FROM archives WHERE table_nom = %s AND mois = %s", (table, mois))
+            inscrits = {r[0] for r in c.fetchall()}
+    dossier = os.path.join(ARCHIVE_DIR, table)
+    partie = 1
+    while True:
+        nom = f"{mois:%Y-%m}.parquet" if partie == 1 else f"{mois:%Y-%m}.{partie}.parquet"
+        fichier = os.path.abspath(os.path.join(dossier, nom))
+        if fichier not in inscrits:
+            return fichier
+        partie += 1
+
+
+def archiver_mois(table, mois):
+    """Écrit un mois de `table` dans ARCHIVE_DIR/<table>/AAAA-MM.parquet, puis le retire de la base.
+
+    Le fichier est écrit et relu avant toute modification de la base ; la suppression du mois, le cumul
+    des montants par client (soldes_archives) et l'inscription dans `archives` sont validés ensemble.
+    Renvoie le nombre de lignes archivées.
+    """
+    import pyarrow.parquet as pq
+
+    suivant = debut_mois(mois, 1)
+    colonnes = ARCHIVE_COLONNES[table]
+    os.makedirs(os.path.join(ARCHIVE_DIR, table), exist_ok=True)
+    fichier = fichier_archive_libre(table, mois)
+    sql = f"SELECT {', '.join(colonnes)} FROM {table} WHERE date >= '{mois}' AND date < '{suivant}' ORDER BY date, id"
+    with export_table(sql, 'parquet', types_colonnes=colonnes) as source, open(f"{fichier}.tmp", 'wb') as cible:
+        shutil.copyfileobj(source, cible)
+        cible.flush()
+        os.fsync(cible.fileno())
+    os.replace(f"{fichier}.tmp", fichier)
+    nb_lignes = pq.ParquetFile(fichier).metadata.num_rows
+
+    colonne_solde, montant = ARCHIVE_SOLDES[table]
+    with db_transaction() as conn:
+        with conn.cursor() as c:
+            if DB_DIALECTE == 'postgresql':
+                # Plus aucune écriture sur le mois jusqu'à la suppression de sa partition
+                c.execute(f"LOCK TABLE {table}_{mois:%Y%m} IN ACCESS EXCLUSIVE MODE")
+            c.execute(f"SELECT COUNT(*) FROM {table} WHERE date >= %s AND date < %s", (mois, suivant))
+            if c.fetchone()[0] != nb_lignes:
+                raise ArchiveError(f"{table} {mois:%Y-%m} : lignes ajoutées pendant l'écriture du fichier.")
+            c.execute(f"""
+                INSERT INTO soldes_archives (client_id, {colonne_solde})
+                SELECT client_id, SUM({montant}::float8) FROM {table}
+                WHERE date >= %s AND date < %s AND client_id IS NOT NULL
+                GROUP BY client_id
+                ON CONFLICT (client_id) DO UPDATE SET {colonne_solde} = soldes_archives.{colonne_solde} + excluded.{colonne_solde}
+            """, (mois, suivant))
+            if DB_DIALECTE == 'postgresql':
+                c.execute(f"DROP TABLE {table}_{mois:%Y%m}")
+            else:
+                c.execute(f"DELETE FROM {table} WHERE date >= %s AND date < %s", (mois, suivant))
+            c.execute("INSERT INTO archives (table_nom, mois, fichier, nb_lignes) VALUES (%s, %s, %s, %s)",
+                      (table, mois, fichier, nb_lignes))
+            notify_write(c)
+    get_data_version().bump()
+    return nb_lignes
+
+
+def archiver_mois_anciens(retention_mois=None):
+    """Archive les mois antérieurs à la rétention, table par table ; renvoie [(table, mois, nb_lignes)].
+
+    Un seul processus archive à la fois (verrou consultatif sous PostgreSQL) ; les autres passent leur tour.
+    """
+    retention_mois = max(retention_mois or ARCHIVE_RETENTION_MOIS, ARCHIVE_RETENTION_MIN)
+    limite = debut_mois(datetime.date.today(), -retention_mois)
+    archives = []
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            if DB_DIALECTE == 'postgresql':
+                c.execute("SELECT pg_try_advisory_lock(%s)", (ARCHIVE_LOCK_ID,))
+                if not c.fetchone()[0]:
+                    return archives
+        try:
+            for table in TABLES_PARTITIONNEES:
+                with conn.cursor() as c:
+                    mois_anciens = mois_en_base(c, table, limite)
+                conn.commit()
+                for mois in mois_anciens:
+                    # Un mois en échec est retenté au prochain passage sans bloquer les suivants
+                    try:
+                        archives.append((table, mois, archiver_mois(table, mois)))
+                    except Exception as e:
+                        logging.getLogger('stock_app.archives').error("%s %s non archivé : %s", table, f"{mois:%Y-%m}", e)
+        finally:
+            if DB_DIALECTE == 'postgresql':
+                with conn.cursor() as c:
+                    c.execute("SELECT pg_advisory_unlock(%s)", (ARCHIVE_LOCK_ID,))
+                conn.commit()
+    return archives
+
+
+@st.cache_resource
+def start_maintenance_mensuelle():
+    """Thread qui crée les partitions à venir et archive les mois anciens, une fois par ARCHIVE_INTERVAL."""
+    journal = logging.getLogger('stock_app.archives')
+
+    def maintenir():
+        while True:
+            try:
+                if DB_DIALECTE == 'postgresql':
+                    with db_transaction() as conn:
+                        with conn.cursor() as c:
+                            creer_partitions_a_venir(c)
+                if ARCHIVE_RETENTION_MOIS:
+                    for table, mois, nb_lignes in archiver_mois_anciens():
+                        journal.warning("%s %s archivé : %d lignes", table, f"{mois:%Y-%m}", nb_lignes)
+            except Exception as e:
+                journal.error("Maintenance mensuelle impossible : %s", e)
+            time.sleep(ARCHIVE_INTERVAL)
+
+    thread = threading.Thread(target=maintenir, name="maintenance-mensuelle", daemon=True)
+    thread.start()
+    return thread
+
+
+if DB_DIALECTE == 'postgresql' or ARCHIVE_RETENTION_MOIS:
+    start_maintenance_mensuelle()
+
+
+def fichiers_archives(table, debut=None, fin=None):
+    """Fichiers Parquet des mois archivés de `table` qui recoupent la période [debut, fin], du plus ancien au plus récent."""
+    mois_archives = cached_query("SELECT mois, fichier FROM archives WHERE table_nom = %s ORDER BY mois", (table,))
+    return tuple(fichier for mois, fichier in mois_archives
+                 if (fin is None or mois <= fin) and (debut is None or debut_mois(mois, 1) > debut))
+
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def lire_archives(fichiers, filtres=(), colonnes=None):
+    """Lignes archivées (DataFrame) ; `filtres` au format pyarrow, appliqués à la lecture. Les fichiers ne changent pas."""
+    import pyarrow.parquet as pq
+
+    if not fichiers:
+        return pd.DataFrame(columns=colonnes)
+    return pq.read_table(list(fichiers), filters=list(filtres) or None, columns=colonnes).to_pandas()
+
+
+def export_avec_archives(table, sql, format_fichier='csv'):
+    """Comme export_table, précédé des mois archivés de `table` (mêmes colonnes, lus fichier par fichier)."""
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    flux_csv = export_table(sql, 'csv')
+    colonnes = flux_csv.readline().decode('utf-8').strip().split(',')
+    schema = pa.schema([(col, pa.type_for_alias(ARCHIVE_COLONNES[table][col])) for col in colonnes])
+    sortie = tempfile.TemporaryFile()
+    with flux_csv:
+        if format_fichier == 'csv':
+            sortie.write(','.join(colonnes).encode('utf-8') + b'\n')
+            for fichier in fichiers_archives(table):
+                for lot in pq.ParquetFile(fichier).iter_batches(columns=colonnes):
+                    pa_csv.write_csv(pa.Table.from_batches([lot]), sortie, pa_csv.WriteOptions(include_header=False))
+            shutil.copyfileobj(flux_csv, sortie)
+        else:
+            flux_csv.seek(0)
+            conversion = pa_csv.ConvertOptions(column_types=dict(zip(colonnes, schema.types)))
+            with pq.ParquetWriter(sortie, schema, compression='zstd') as writer:
+                for fichier in fichiers_archives(table):
+                    for lot in pq.ParquetFile(fichier).iter_batches(columns=colonnes):
+                        writer.write_table(pa.Table.from_batches([lot]).cast(schema))
+                for lot in pa_csv.open_csv(flux_csv, convert_options=conversion):
+                    writer.write_batch(lot)
+    sortie.seek(0)
+    return sortie
+
+
+# --- CRÉANCES CLIENTS : ANCIENNETÉ, PLAFONDS ET RAPPROCHEMENT ---
+
+# Part du plafond à partir de laquelle un client est signalé comme proche de sa limite
+CREANCES_SEUIL_ALERTE = float(os.environ.get('CREANCES_SEUIL_ALERTE', '0.8'))
+# Intervalle (s) entre deux recalculs complets ; entre-temps seuls les clients ayant de nouvelles écritures sont recalculés
+CREANCES_RECALCUL_COMPLET = int(os.environ.get('CREANCES_RECALCUL_COMPLET', '900'))
+# Tranches d'ancienneté (jours) : libellé -> âge maximal inclus de la vente à crédit
+CREANCES_TRANCHES = {"0-30 j": 30, "31-60 j": 60, "61-90 j": 90, "90+ j": None}
+
+# Les paiements soldent les crédits les plus anciens d'abord : le reste dû de chaque vente à crédit est la part
+# de son cumul que les paiements du client ne couvrent pas. Un seul passage sur ventes et paiements.
+CREANCES_SQL = """
+    WITH credits AS (
+        SELECT client_id, jour, montant_credit,
+               SUM(montant_credit) OVER (PARTITION BY client_id ORDER BY ordre, date, id ROWS UNBOUNDED PRECEDING) AS cumul
+        FROM (
+            -- Les crédits des mois archivés sont les plus anciens : soldés en premier, sinon dans la dernière tranche
+            SELECT client_id, 0 AS ordre, NULL AS date, 0 AS id, NULL AS jour, credits AS montant_credit
+            FROM soldes_archives
+            WHERE credits > 0 {filtre}
+            UNION ALL
+            SELECT client_id, 1, date, id, date::date, montant_credit::float8
+            FROM ventes
+            WHERE montant_credit > 0 AND client_id IS NOT NULL {filtre}
+        ) lignes
+    ), payes AS (
+        SELECT client_id, SUM(montant) AS total
+        FROM (
+            SELECT client_id, paiements AS montant FROM soldes_archives WHERE paiements > 0 {filtre}
+            UNION ALL
+            SELECT client_id, montant::float8 FROM paiements WHERE client_id IS NOT NULL {filtre}
+        ) lignes
+        GROUP BY client_id
+    ), restes AS (
+        SELECT c.client_id, c.jour, c.cumul,
+               LEAST(c.montant_credit, GREATEST(c.cumul - COALESCE(p.total, 0), 0)) AS reste
+        FROM credits c
+        LEFT JOIN payes p ON p.client_id = c.client_id
+    ), par_client AS (
+        SELECT client_id, MAX(cumul) AS credits, 0 AS paye,
+               SUM(reste) FILTER (WHERE jour >= %(j30)s) AS t1,
+               SUM(reste) FILTER (WHERE jour < %(j30)s AND jour >= %(j60)s) AS t2,
+               SUM(reste) FILTER (WHERE jour < %(j60)s AND jour >= %(j90)s) AS t3,
+               SUM(reste) FILTER (WHERE jour < %(j90)s OR jour IS NULL) AS t4
+        FROM restes
+        GROUP BY client_id
+        UNION ALL
+        SELECT client_id, 0, total, 0, 0, 0, 0 FROM payes
+    )
+    SELECT client_id,
+           COALESCE(SUM(credits), 0) - COALESCE(SUM(paye), 0) AS grand_livre,
+           COALESCE(SUM(t1), 0), COALESCE(SUM(t2), 0), COALESCE(SUM(t3), 0), COALESCE(SUM(t4), 0)
+    FROM par_client
+    GROUP BY client_id
+"""
+# Recalcul incrémental : seuls les clients ayant une vente à crédit ou un paiement au-delà des derniers id vus
+CREANCES_FILTRE_NOUVEAUX = """AND client_id IN (
+    SELECT client_id FROM ventes WHERE id > %(vente_id)s AND montant_credit > 0
+    UNION
+    SELECT client_id FROM paiements WHERE id > %(paiement_id)s
+)"""
+
+
+class EncoursCreances:
+    """Grand livre et ancienneté des créances par client, gardés en mémoire et tenus à jour par client.
+
+    Un recalcul complet a lieu au changement de jour (les créances vieillissent), toutes les
+    CREANCES_RECALCUL_COMPLET secondes ou à la demande ; sinon, après une écriture (DataVersion) ou au plus
+    tard après CACHE_TTL secondes, seuls les clients ayant de nouvelles ventes à crédit ou de nouveaux
+    paiements sont recalculés. Une transaction validée hors ordre des id est rattrapée au recalcul complet.
+    """
+
+    COLONNES = ['client_id', 'grand_livre'] + list(CREANCES_TRANCHES)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.df = pd.DataFrame(columns=self.COLONNES).set_index('client_id')
+        self.jour = None
+        self.vente_id = self.paiement_id = 0
+        self.complet_le = self.actualise_le = 0.0
+        self.version = None
+        self.derniere_mise_a_jour = None  # (type, nb clients recalculés, durée s, horodatage)
+
+    def _calculer(self, c, params, incremental):
+        sql = CREANCES_SQL.format(filtre=CREANCES_FILTRE_NOUVEAUX if incremental else '')
+        c.execute(sql, params)
+        df = pd.DataFrame(c.fetchall(), columns=self.COLONNES).set_index('client_id')
+        return df.astype(float)
+
+    def actualiser(self, forcer_complet=False):
+        """Met le résultat à jour si nécessaire et renvoie (DataFrame indexé par client_id, dernière mise à jour)."""
+        with self._lock:
+            maintenant = time.monotonic()
+            aujourd_hui = datetime.date.today()
+            version = get_data_version().value
+            complet = (forcer_complet or self.jour != aujourd_hui
+                       or maintenant - self.complet_le >= CREANCES_RECALCUL_COMPLET)
+            if not complet and version == self.version and maintenant - self.actualise_le < CACHE_TTL:
+                return self.df, self.derniere_mise_a_jour
+
+            debut = time.perf_counter()
+            params = {
+                'j30': aujourd_hui - datetime.timedelta(days=30),
+                'j60': aujourd_hui - datetime.timedelta(days=60),
+                'j90': aujourd_hui - datetime.timedelta(days=90),
+                'vente_id': self.vente_id,
+                'paiement_id': self.paiement_id,
+            }
+            with get_db_connection() as conn:
+                with conn.cursor() as c:
+                    # Relevés avant le calcul : une écriture concurrente est au pire recalculée deux fois
+                    c.execute("SELECT (SELECT COALESCE(MAX(id), 0) FROM ventes), (SELECT COALESCE(MAX(id), 0) FROM paiements)")
+                    vente_id, paiement_id = c.fetchone()
+                    df = self._calculer(c, params, incremental=not complet)
+
+            if complet:
+                self.df = df
+                self.jour, self.complet_le = aujourd_hui, maintenant
+            elif not df.empty:
+                self.df = pd.concat([self.df.drop(df.index, errors='ignore'), df])
+            self.vente_id, self.paiement_id = vente_id, paiement_id
+            self.version, self.actualise_le = version, maintenant
+            self.derniere_mise_a_jour = ("complète" if complet else "incrémentale", len(df),
+                                         time.perf_counter() - debut, datetime.datetime.now())
+            return self.df, self.derniere_mise_a_jour
+
+
+@st.cache_resource
+def get_encours_creances():
+    return EncoursCreances()
+
+
+def rapport_creances(forcer_complet=False):
+    """Ancienneté, utilisation du plafond et écart solde_du / grand livre pour chaque client concerné."""
+    df_encours, maj = get_encours_creances().actualiser(forcer_complet)
+    df = read_sql("SELECT id AS client_id, nom, plafond_credit, solde_du FROM clients").set_index('client_id')
+    # Sans client, read_sql renvoie des colonnes de type object : on force le type numérique
+    numeriques = ['plafond_credit', 'solde_du'] + EncoursCreances.COLONNES[1:]
+    df = df.join(df_encours, how='left').fillna({col: 0.0 for col in EncoursCreances.COLONNES[1:]}).astype(
+        {col: float for col in numeriques})
+    df['ecart'] = (df['solde_du'] - df['grand_livre']).round(2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['utilisation'] = np.where(df['plafond_credit'] > 0, df['solde_du'] / df['plafond_credit'],
+                                     np.where(df['solde_du'] > 0, np.inf, 0.0))
+    df['statut'] = np.select(
+        [df['solde_du'] > df['plafond_credit'] + 0.005,
+         (df['solde_du'] > 0) & (df['utilisation'] >= CREANCES_SEUIL_ALERTE)],
+        ["🔴 Au-delà du plafond", "🟠 Proche du plafond"], default="")
+    concernes = (df['solde_du'].abs() >= 0.005) | (df['grand_livre'].abs() >= 0.005) | (df['ecart'] != 0)
+    return df[concernes].reset_index(), maj
+
+
 # --- Fonction principale de gestion de la vente (CORRECTION DE L'ENREGISTREMENT CRÉDIT) ---
 def handle_sale(cart_key, is_credit_sale, client_selection_optional=False):
     current_cart = st.session_state[cart_key]
@@ -134,7 +2225,7 @@ def handle_sale(cart_key, is_credit_sale, client_selection_optional=False):
         st.subheader("Finalisation de la Transaction")
         
         sql_clients_list = """SELECT id, nom, solde_du, plafond_credit FROM clients"""
-        clients_db = exec_query(sql_clients_list, fetch=True)
+        clients_db = cached_query(sql_clients_list)
         option_client = {c[1]: (c[0], c[2], c[3]) for c in clients_db} 
         
         client_choices = ["(Optionnel) Choisir un client"] + list(option_client.keys())
@@ -154,45 +2245,36 @@ def handle_sale(cart_key, is_credit_sale, client_selection_optional=False):
             if st.form_submit_button(f"✅ Valider la Vente ({'CRÉDIT' if is_credit_sale else 'COMPTANT'})"):
                 
                 client_id = None
-                montant_credit_transaction = 0.0
                 
                 if choix_client and choix_client != "(Optionnel) Choisir un client":
-                    cid, solde_du, plafond = option_client[choix_client]
-                    client_id = cid
+                    client_id = option_client[choix_client][0]
                 
                 
+                if is_credit_sale and not client_id:
+                    st.error("❌ Veuillez sélectionner un client pour une vente à crédit.")
+                    st.stop()
+
+                # Refus immédiat si le plafond connu est déjà dépassé ; la base revérifie à l'application
                 if is_credit_sale:
-                    if not client_id:
-                        st.error("❌ Veuillez sélectionner un client pour une vente à crédit.")
+                    _, solde_du, plafond = option_client[choix_client]
+                    if WRITE_BEHIND:
+                        solde_du += get_write_behind().credit_en_attente(client_id)
+                    if solde_du + total_panier > plafond:
+                        st.error(f"❌ CRÉDIT REFUSÉ ! Le solde de {solde_du + total_panier:.2f} € dépasse le plafond de {plafond:.2f} €.")
                         st.stop()
-                        
-                    nouveau_solde = solde_du + total_panier
-                    if nouveau_solde > plafond:
-                        st.error(f"❌ CRÉDIT REFUSÉ ! Le solde de {nouveau_solde:.2f} € dépasse le plafond de {plafond:.2f} €.")
-                        st.stop()
-                    
-                    # Mise à jour du solde du client (ACTION CRITIQUE)
-                    sql_update_solde = "UPDATE clients SET solde_du = solde_du + %s WHERE id = %s"
-                    exec_query(sql_update_solde, (total_panier, client_id))
-                    montant_credit_transaction = total_panier
-                
-                
-                # Enregistrement des produits vendus et mise à jour du stock
-                is_first_item = True
-                for item in current_cart:
-                    
-                    # Enregistre le montant total du crédit (montant_credit_transaction) uniquement sur le premier article
-                    # pour que l'historique puisse le filtrer facilement.
-                    credit_amount_to_record = montant_credit_transaction if is_first_item else 0.0
-                    is_first_item = False 
-                    
-                    sql_vente = "INSERT INTO ventes (produit_id, quantite, client_id, montant_credit) VALUES (%s, %s, %s, %s)"
-                    exec_query(sql_vente, (item['id'], item['quantite'], client_id, credit_amount_to_record))
-                    
-                    sql_stock = "UPDATE produits SET quantite = quantite - %s WHERE id = %s"
-                    exec_query(sql_stock, (item['quantite'], item['id']))
-                
-                st.success(f"🥳 Vente {('à Crédit' if is_credit_sale else 'Comptant')} enregistrée. Total: {total_panier:.2f} €.")
+
+                # Journal local (ou transaction unique si l'écriture différée est désactivée)
+                try:
+                    soumettre_vente(current_cart, client_id, is_credit_sale)
+                except CheckoutError as e:
+                    st.error(f"❌ {e}")
+                    st.stop()
+                except Exception as e:
+                    st.error(f"❌ Vente non enregistrée (aucune modification effectuée) : {e}")
+                    st.stop()
+
+                st.success(f"🥳 Vente {('à Crédit' if is_credit_sale else 'Comptant')} enregistrée. Total: {total_panier:.2f} €."
+                           + (" Synchronisation en cours." if WRITE_BEHIND else ""))
                 
                 if is_credit_sale:
                     clear_cart_credit()
@@ -202,80 +2284,75 @@ def handle_sale(cart_key, is_credit_sale, client_selection_optional=False):
                 st.rerun() 
 
 
-# --- NOUVEAU SYSTÈME DE NAVIGATION PAR ONGLETS ---
-
-tab_vendre, tab_clients, tab_remb, tab_historique, tab_stock, tab_ajouter = st.tabs(
-    ["Vendre 🛒", "Clients & Crédit 👤", "Remboursement Client 💵", "Historique Ventes 🧾", "Stock 📦", "Ajouter Produit ➕"]
-)
+# --- PAGES DE L'APPLICATION ---
 
 # ----------------------------------------------------
 #               ONGLET : VENDRE
 # ----------------------------------------------------
-with tab_vendre:
+@st.fragment
+def panneau_vente(cart_key, is_credit_sale):
+    """Ajout au panier et finalisation : un changement du panier ne réexécute que ce fragment."""
+    with mesurer_fragment():
+        _panneau_vente(cart_key, is_credit_sale)
+
+
+def _panneau_vente(cart_key, is_credit_sale):
+    suffix = 'credit' if is_credit_sale else 'cash'
+    libelle = 'Crédit' if is_credit_sale else 'Comptant'
+
+    st.subheader(f"1. Ajouter des articles au panier {libelle}")
+    col_add, col_finalize = st.columns([1, 1])
+
+    with col_add:
+        st.text_input("📷 Scanner un code-barres", key=f"scan_{suffix}",
+                      on_change=scan_code_barre_callback, args=(cart_key, f"scan_{suffix}"))
+        recherche = st.text_input("🔎 Rechercher un produit (nom ou code-barres)", key=f"recherche_{suffix}")
+        # Seuls les meilleurs résultats sont chargés et envoyés au navigateur, jamais le catalogue complet
+        produits_db = search_produits(recherche)
+        option_produit = {p[1]: (p[0], p[2], p[3]) for p in produits_db} 
+        
+        with st.form(f"form_add_to_cart_{suffix}", clear_on_submit=True):
+            choix_produit = st.selectbox("Produit", list(option_produit.keys()) if option_produit else [], key=f"sel_prod_add_{suffix}")
+            
+            if choix_produit:
+                pid, prix, stock_actuel = option_produit[choix_produit]
+                st.info(f"Prix unitaire: {prix} € | Stock disponible: {stock_actuel}")
+                
+                qty_add = st.number_input("Quantité à ajouter", min_value=1, max_value=stock_actuel, step=1, value=1, key=f"qty_add_input_{suffix}")
+                
+                if st.form_submit_button(f"🛒 Ajouter au Panier {libelle}"):
+                    add_to_cart_callback(pid, choix_produit, prix, stock_actuel, qty_add, cart_key)
+
+        # Après le formulaire : message du scan (callback) comme de l'ajout ci-dessus
+        afficher_message_panier(cart_key)
+
+    with col_finalize:
+        handle_sale(cart_key, is_credit_sale=is_credit_sale, client_selection_optional=not is_credit_sale)
+
+
+def page_vendre():
     st.header("Sélectionner le Type de Transaction")
     
     tab_credit, tab_cash = st.tabs(["Vente à Crédit 💳", "Vente Comptant 💵"])
 
     # SOUS-ONGLET CRÉDIT
     with tab_credit:
-        st.subheader("1. Ajouter des articles au panier Crédit")
-        col_add, col_finalize = st.columns([1, 1])
-
-        with col_add:
-            sql_produits_credit = """SELECT id, nom, prix, quantite FROM produits WHERE quantite > 0 ORDER BY nom"""
-            produits_db = exec_query(sql_produits_credit, fetch=True)
-            option_produit = {p[1]: (p[0], p[2], p[3]) for p in produits_db} 
-            
-            with st.form("form_add_to_cart_credit", clear_on_submit=True):
-                choix_produit = st.selectbox("Produit", list(option_produit.keys()) if option_produit else [], key="sel_prod_add_credit")
-                
-                if choix_produit:
-                    pid, prix, stock_actuel = option_produit[choix_produit]
-                    st.info(f"Prix unitaire: {prix} € | Stock disponible: {stock_actuel}")
-                    
-                    qty_add = st.number_input("Quantité à ajouter", min_value=1, max_value=stock_actuel, step=1, value=1, key="qty_add_input_credit")
-                    
-                    if st.form_submit_button("🛒 Ajouter au Panier Crédit"):
-                        add_to_cart_callback(pid, choix_produit, prix, stock_actuel, qty_add, 'cart_credit')
-
-        with col_finalize:
-            handle_sale('cart_credit', is_credit_sale=True)
+        panneau_vente('cart_credit', is_credit_sale=True)
 
     # SOUS-ONGLET COMPTANT
     with tab_cash:
-        st.subheader("1. Ajouter des articles au panier Comptant")
-        col_add, col_finalize = st.columns([1, 1])
-        
-        with col_add:
-            sql_produits_cash = """SELECT id, nom, prix, quantite FROM produits WHERE quantite > 0 ORDER BY nom"""
-            produits_db = exec_query(sql_produits_cash, fetch=True)
-            option_produit = {p[1]: (p[0], p[2], p[3]) for p in produits_db} 
-            
-            with st.form("form_add_to_cart_cash", clear_on_submit=True):
-                choix_produit = st.selectbox("Produit", list(option_produit.keys()) if option_produit else [], key="sel_prod_add_cash")
-                
-                if choix_produit:
-                    pid, prix, stock_actuel = option_produit[choix_produit]
-                    st.info(f"Prix unitaire: {prix} € | Stock disponible: {stock_actuel}")
-                    
-                    qty_add = st.number_input("Quantité à ajouter", min_value=1, max_value=stock_actuel, step=1, value=1, key="qty_add_input_cash")
-                    
-                    if st.form_submit_button("🛒 Ajouter au Panier Comptant"):
-                        add_to_cart_callback(pid, choix_produit, prix, stock_actuel, qty_add, 'cart_cash')
-
-        with col_finalize:
-            handle_sale('cart_cash', is_credit_sale=False, client_selection_optional=True)
+        panneau_vente('cart_cash', is_credit_sale=False)
 
 
 # ----------------------------------------------------
 #               ONGLET : REMBOURSEMENT CLIENT
 # ----------------------------------------------------
-with tab_remb:
+def page_remboursement():
     st.header("💵 Enregistrement d'un Paiement/Avance Client")
 
     # Utilisation de la variable sécurisée pour la requête SQL
     sql_clients_dette = """SELECT id, nom, solde_du FROM clients WHERE solde_du > 0 ORDER BY nom"""
-    clients_db = exec_query(sql_clients_dette, fetch=True)
+    clients_db = cached_query(sql_clients_dette)
     option_client = {c[1]: (c[0], c[2]) for c in clients_db} 
     
     if not clients_db:
@@ -285,8 +2362,12 @@ with tab_remb:
             choix_client_remb = st.selectbox("Sélectionner le Client qui paie", list(option_client.keys()))
             
             if choix_client_remb:
-                cid, solde_actuel = option_client[choix_client_remb]
-                st.warning(f"Dette actuelle de {choix_client_remb}: {solde_actuel:.2f} €")
+                cid, solde_du = option_client[choix_client_remb]
+                # Paiements déjà encaissés mais pas encore synchronisés : ils ne sont pas encore dans solde_du
+                en_attente = get_write_behind().paiement_en_attente(cid) if WRITE_BEHIND else 0.0
+                solde_actuel = max(solde_du - en_attente, 0.0)
+                st.warning(f"Dette actuelle de {choix_client_remb}: {solde_actuel:.2f} €"
+                           + (f" ({en_attente:.2f} € de paiements en attente de synchronisation déjà déduits)" if en_attente else ""))
                 
                 montant_paye = st.number_input(
                     "Montant payé (Avance)", 
@@ -298,20 +2379,136 @@ with tab_remb:
                 
                 if st.form_submit_button("Enregistrer le Paiement"):
                     
-                    sql_update_solde = "UPDATE clients SET solde_du = solde_du - %s WHERE id = %s"
-                    exec_query(sql_update_solde, (montant_paye, cid))
-                    
-                    sql_paiement = "INSERT INTO paiements (client_id, montant) VALUES (%s, %s)"
-                    exec_query(sql_paiement, (cid, montant_paye))
+                    try:
+                        nouveau_solde = soumettre_paiement(cid, montant_paye, solde_du)
+                    except PaiementError as e:
+                        st.error(f"❌ {e}")
+                        st.stop()
+                    except Exception as e:
+                        st.error(f"❌ Paiement non enregistré (aucune modification effectuée) : {e}")
+                        st.stop()
                     
-                    nouveau_solde = solde_actuel - montant_paye
-                    st.success(f"✅ Paiement de {montant_paye:.2f} € enregistré pour {choix_client_remb}. Nouveau solde dû: {nouveau_solde:.2f} €.")
+                    if nouveau_solde is None:
+                        st.success(f"✅ Paiement de {montant_paye:.2f} € enregistré pour {choix_client_remb}. Synchronisation en cours.")
+                    else:
+                        st.success(f"✅ Paiement de {montant_paye:.2f} € enregistré pour {choix_client_remb}. Nouveau solde dû: {nouveau_solde:.2f} €.")
                     st.rerun()
 
+# ----------------------------------------------------
+#               ONGLET : CRÉANCES
+# ----------------------------------------------------
+CREANCES_LIGNES_AFFICHEES = 200
+# Tris proposés pour la liste des créances (clé d'affichage -> colonnes, ordre croissant)
+CREANCES_TRIS = {
+    "Utilisation du plafond": (['utilisation', 'solde_du'], False),
+    "Plus de 90 jours": (['90+ j', 'grand_livre'], False),
+    "Encours (grand livre)": (['grand_livre'], False),
+    "Nom (A → Z)": (['nom'], True),
+}
+
+
+def page_creances():
+    st.header("📒 Créances Clients : Ancienneté et Risque")
+    if st.button("🔄 Recalcul complet", key="creances_recalcul"):
+        df, maj = rapport_creances(forcer_complet=True)
+    else:
+        df, maj = rapport_creances()
+    if maj:
+        type_maj, nb_clients, duree, horodatage = maj
+        st.caption(f"Mise à jour {type_maj} à {horodatage:%H:%M:%S} : {nb_clients} clients recalculés en {1000 * duree:.0f} ms.")
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Encours (grand livre)", f"{df['grand_livre'].clip(lower=0).sum():.2f} €")
+    col2.metric("Clients débiteurs", f"{int((df['grand_livre'] > 0.005).sum())}")
+    col3.metric("Au-delà du plafond", f"{int((df['statut'] == '🔴 Au-delà du plafond').sum())}")
+    col4.metric(f"Proches du plafond (≥ {CREANCES_SEUIL_ALERTE:.0%})", f"{int((df['statut'] == '🟠 Proche du plafond').sum())}")
+
+    st.subheader("Ancienneté des créances")
+    totaux_tranches = df[list(CREANCES_TRANCHES)].sum()
+    for col, (tranche, montant) in zip(st.columns(len(CREANCES_TRANCHES)), totaux_tranches.items()):
+        col.metric(tranche, f"{montant:.2f} €")
+    st.bar_chart(totaux_tranches.rename("Montant (€)"))
+
+    st.subheader("Clients")
+    col_filtre, col_tri = st.columns([1, 1])
+    with col_filtre:
+        a_risque = st.checkbox("Seulement les clients proches ou au-delà de leur plafond", key="creances_risque")
+    with col_tri:
+        tri = st.selectbox("Trier par", list(CREANCES_TRIS.keys()), key="creances_tri")
+    df_liste = df[df['statut'] != ""] if a_risque else df[df['grand_livre'] > 0.005]
+    colonnes_tri, croissant = CREANCES_TRIS[tri]
+    df_liste = df_liste.sort_values(colonnes_tri, ascending=croissant)
+    if df_liste.empty:
+        st.info("Aucun client à afficher.")
+    else:
+        st.dataframe(
+            df_liste.head(CREANCES_LIGNES_AFFICHEES).assign(utilisation=lambda d: 100 * d['utilisation'].replace(np.inf, np.nan)),
+            column_order=['statut', 'nom', 'plafond_credit', 'solde_du', 'utilisation', 'grand_livre', *CREANCES_TRANCHES],
+            column_config={
+                "statut": "Alerte",
+                "nom": "Client",
+                "plafond_credit": st.column_config.NumberColumn("Plafond (€)", format="%.2f"),
+                "solde_du": st.column_config.NumberColumn("Solde Dû (€)", format="%.2f"),
+                "utilisation": st.column_config.NumberColumn("Utilisation", format="%.0f %%"),
+                "grand_livre": st.column_config.NumberColumn("Grand livre (€)", format="%.2f"),
+                **{tranche: st.column_config.NumberColumn(f"{tranche} (€)", format="%.2f") for tranche in CREANCES_TRANCHES},
+            },
+            hide_index=True, use_container_width=True
+        )
+        if len(df_liste) > CREANCES_LIGNES_AFFICHEES:
+            st.caption(f"{CREANCES_LIGNES_AFFICHEES} premiers clients sur {len(df_liste)}.")
+
+    st.subheader("Rapprochement solde dû / grand livre")
+    st.caption("Grand livre = ventes à crédit − paiements. Un écart signale un solde_du modifié hors d'une vente ou d'un paiement.")
+    df_ecarts = df[df['ecart'] != 0].sort_values('ecart', key=abs, ascending=False)
+    if df_ecarts.empty:
+        st.success("✅ Le solde dû de tous les clients correspond au grand livre.")
+    else:
+        st.warning(f"{len(df_ecarts)} clients présentent un écart avec le grand livre :")
+        st.dataframe(
+            df_ecarts[['client_id', 'nom', 'solde_du', 'grand_livre', 'ecart']],
+            column_config={
+                "client_id": "ID", "nom": "Client",
+                "solde_du": st.column_config.NumberColumn("Solde Dû (€)", format="%.2f"),
+                "grand_livre": st.column_config.NumberColumn("Grand livre (€)", format="%.2f"),
+                "ecart": st.column_config.NumberColumn("Écart (€)", format="%+.2f"),
+            },
+            hide_index=True, use_container_width=True
+        )
+
 # ----------------------------------------------------
 #               ONGLET : CLIENTS & CRÉDIT
 # ----------------------------------------------------
-with tab_clients:
+RELEVE_PAGE_SIZE = 50
+CLIENTS_PAGE_SIZE = 50
+# Tris proposés (clé d'affichage -> ORDER BY), id en dernier pour un ordre stable entre les pages
+CLIENTS_TRIS = {
+    "Solde dû (décroissant)": "solde_du DESC, id",
+    "Nom (A → Z)": "nom, id",
+    "Plafond (décroissant)": "plafond_credit DESC, id",
+}
+
+
+def releve_archive(client_id):
+    """Relevé des mois archivés d'un client, plus récent d'abord, avec le solde cumulé depuis sa première opération."""
+    ventes = lire_archives(fichiers_archives('ventes'), (('client_id', '=', client_id),),
+                           ['date', 'id', 'produit_id', 'quantite', 'montant_credit'])
+    paiements = lire_archives(fichiers_archives('paiements'), (('client_id', '=', client_id),), ['date', 'id', 'montant'])
+    noms_produits = dict(cached_query("SELECT id, nom FROM produits"))
+    df = pd.concat([
+        pd.DataFrame({'Date': ventes['date'], 'ordre': 0, 'id': ventes['id'], 'Type': 'VENTE',
+                      'Libellé': ventes['produit_id'].map(noms_produits), 'Qté': ventes['quantite'],
+                      'Mode de Paiement': np.where(ventes['montant_credit'] > 0, 'CRÉDIT', 'COMPTANT'),
+                      'Crédit accordé (€)': ventes['montant_credit'], 'Montant Payé (€)': 0.0}),
+        pd.DataFrame({'Date': paiements['date'], 'ordre': 1, 'id': paiements['id'], 'Type': 'PAIEMENT',
+                      'Libellé': 'Paiement / Avance', 'Qté': None, 'Mode de Paiement': None,
+                      'Crédit accordé (€)': 0.0, 'Montant Payé (€)': paiements['montant']}),
+    ], ignore_index=True).sort_values(['Date', 'ordre', 'id'])
+    df['Solde (€)'] = (df['Crédit accordé (€)'] - df['Montant Payé (€)']).cumsum()
+    return df.iloc[::-1].drop(columns=['ordre', 'id'])
+
+
+def page_clients():
     st.header("Gestion des Clients, Plafonds et Historique")
 
     with st.expander("➕ Ajouter un nouveau client"):
@@ -325,84 +2522,170 @@ with tab_clients:
                 exec_query(sql, (nom, adresse, plafond_credit))
                 st.success(f"👤 Client '{nom}' créé avec un plafond de {plafond_credit} €")
 
+    # Totaux sur tous les clients en une seule agrégation
+    df_totaux = read_sql("""
+        SELECT
+            COUNT(*) AS nb_clients,
+            COUNT(*) FILTER (WHERE solde_du > 0) AS nb_debiteurs,
+            COALESCE(SUM(solde_du), 0) AS encours,
+            COALESCE(SUM(GREATEST(plafond_credit - solde_du, 0)), 0) AS marge
+        FROM clients
+    """)
+    totaux = df_totaux.iloc[0]
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Clients endettés", f"{int(totaux['nb_debiteurs'])} / {int(totaux['nb_clients'])}")
+    col2.metric("Encours total", f"{totaux['encours']:.2f} €")
+    col3.metric("Marge de crédit restante", f"{totaux['marge']:.2f} €")
+
     st.subheader("Liste des Clients")
-    sql_clients_list = """SELECT id, nom, adresse, plafond_credit, solde_du FROM clients ORDER BY solde_du DESC"""
-    df_clients = pd.read_sql(sql_clients_list, get_db_connection())
-
-    def color_du(val):
-        color = 'red' if val > 0 else 'black'
-        return f'color: {color}'
-
-    st.dataframe(
-        df_clients.style.applymap(color_du, subset=['solde_du']),
-        column_config={
-            "plafond_credit": st.column_config.NumberColumn("Plafond (€)", format="%.2f"),
-            "solde_du": st.column_config.NumberColumn("Solde Dû (€)", format="%.2f")
-        },
-        use_container_width=True
-    )
+    col_recherche, col_tri, col_page = st.columns([2, 1, 1])
+    with col_recherche:
+        recherche = st.text_input("🔎 Rechercher un client (début du nom)", key="clients_recherche")
+    with col_tri:
+        tri = st.selectbox("Trier par", list(CLIENTS_TRIS.keys()), key="clients_tri")
+    with col_page:
+        page = st.number_input("Page", min_value=1, value=1, step=1, key="clients_page")
+
+    motif = recherche.strip().lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    # Pagination, tri et recherche côté serveur : seule la page affichée est lue
+    sql_clients_list = f"""
+    SELECT id, nom, adresse, plafond_credit, solde_du
+    FROM clients
+    WHERE lower(nom) LIKE %s
+    ORDER BY {CLIENTS_TRIS[tri]}
+    LIMIT %s OFFSET %s
+    """
+    df_clients = read_sql(sql_clients_list, (f"{motif}%", CLIENTS_PAGE_SIZE, (page - 1) * CLIENTS_PAGE_SIZE))
+
+    if df_clients.empty:
+        st.info("Fin de la liste : revenez à une page précédente." if page > 1 else "Aucun client trouvé.")
+    else:
+        def color_du(col):
+            return np.where(col > 0, 'color: red', 'color: black')
+
+        st.dataframe(
+            df_clients.style.apply(color_du, subset=['solde_du']),
+            column_config={
+                "plafond_credit": st.column_config.NumberColumn("Plafond (€)", format="%.2f"),
+                "solde_du": st.column_config.NumberColumn("Solde Dû (€)", format="%.2f")
+            },
+            use_container_width=True
+        )
+        if not recherche.strip():
+            st.caption(f"{int(totaux['nb_clients'])} clients — page {page} / {-(-int(totaux['nb_clients']) // CLIENTS_PAGE_SIZE)}")
 
     st.markdown("---")
     st.subheader("Historique Détaillé du Client (Ventes et Paiements)")
     
-    client_list = df_clients['nom'].tolist()
-    client_ids = {row['nom']: row['id'] for index, row in df_clients.iterrows()}
+    # Choix parmi les clients de la page affichée (utiliser la recherche pour en trouver un autre)
+    noms_clients = dict(zip(df_clients['id'], df_clients['nom'])) if not df_clients.empty else {}
     
-    if client_list:
-        choix_client_hist = st.selectbox("Choisir le client pour l'historique", client_list)
-        selected_client_id = client_ids[choix_client_hist]
+    if noms_clients:
+        selected_client_id = st.selectbox("Choisir le client pour l'historique", list(noms_clients.keys()),
+                                          format_func=noms_clients.get)
+        choix_client_hist = noms_clients[selected_client_id]
         
-        # 1. Historique des ventes (Produits pris)
-        st.markdown("##### 🧾 Produits pris (Comptant et Crédit)")
-        sql_ventes = """
-        SELECT 
-            p.nom AS "Produit",
-            v.quantite AS "Qté",
-            v.montant_credit AS "Crédit total",
-            v.date AS "Date Vente"
-        FROM ventes v
-        JOIN produits p ON v.produit_id = p.id
-        WHERE v.client_id = %s
-        ORDER BY v.date DESC
-        """
-        df_ventes = pd.read_sql(sql_ventes, get_db_connection(), params=(selected_client_id,))
-        
-        if not df_ventes.empty:
-            
-            df_ventes['Mode de Paiement'] = df_ventes['Crédit total'].apply(lambda x: "CRÉDIT" if x > 0 else "COMPTANT")
-            
-            df_ventes['Montant Crédit (€)'] = df_ventes.apply(
-                lambda row: row['Crédit total'] if row['Mode de Paiement'] == 'CRÉDIT' else 0.0, axis=1
-            )
-            
-            st.dataframe(df_ventes[['Date Vente', 'Produit', 'Qté', 'Montant Crédit (€)', 'Mode de Paiement']], use_container_width=True)
-        else:
-            st.info(f"{choix_client_hist} n'a pas de ventes enregistrées (ni comptant, ni crédit).")
-
-        # 2. Historique des paiements (Avances)
-        st.markdown("##### 💸 Historique des Paiements (Avances)")
-        sql_paiements = """
-        SELECT 
-            montant AS "Montant Payé (€)",
-            date AS "Date Paiement"
-        FROM paiements
-        WHERE client_id = %s
-        ORDER BY date DESC
+        # Relevé unique ventes + paiements ; le solde cumulé est calculé par PostgreSQL (fonction de fenêtre),
+        # à partir du solde des mois archivés, et le nom des produits n'est joint qu'aux lignes de la page affichée.
+        st.markdown("##### 🧾 Relevé de compte (Produits pris et Paiements)")
+        sql_releve = """
+        WITH mouvements AS (
+            SELECT date, 0 AS ordre, id, produit_id, quantite, montant_credit AS debit, 0.0 AS credit
+            FROM ventes
+            WHERE client_id = %(cid)s
+            UNION ALL
+            SELECT date, 1, id, NULL, NULL, 0.0, montant
+            FROM paiements
+            WHERE client_id = %(cid)s
+        ), page AS (
+            SELECT *,
+                   SUM(debit - credit) OVER (ORDER BY date, ordre, id ROWS UNBOUNDED PRECEDING) AS solde,
+                   COUNT(*) OVER () AS nb_lignes
+            FROM mouvements
+            ORDER BY date DESC, ordre DESC, id DESC
+            LIMIT %(limit)s OFFSET %(offset)s
+        ), ouverture AS (
+            SELECT COALESCE(SUM(credits - paiements), 0) AS solde FROM soldes_archives WHERE client_id = %(cid)s
+        )
+        SELECT
+            m.date AS "Date",
+            CASE WHEN m.ordre = 0 THEN 'VENTE' ELSE 'PAIEMENT' END AS "Type",
+            COALESCE(p.nom, 'Paiement / Avance') AS "Libellé",
+            m.quantite AS "Qté",
+            CASE WHEN m.ordre = 1 THEN NULL WHEN m.debit > 0 THEN 'CRÉDIT' ELSE 'COMPTANT' END AS "Mode de Paiement",
+            m.debit AS "Crédit accordé (€)",
+            m.credit AS "Montant Payé (€)",
+            m.solde + o.solde AS "Solde (€)",
+            m.nb_lignes
+        FROM page m
+        CROSS JOIN ouverture o
+        LEFT JOIN produits p ON m.produit_id = p.id
+        ORDER BY m.date DESC, m.ordre DESC, m.id DESC
         """
-        df_paiements = pd.read_sql(sql_paiements, get_db_connection(), params=(selected_client_id,))
+        page = st.number_input("Page du relevé (1 = plus récente)", min_value=1, value=1, step=1,
+                               key=f"releve_page_{selected_client_id}")
+        df_releve = read_sql(sql_releve, {'cid': selected_client_id, 'limit': RELEVE_PAGE_SIZE,
+                                          'offset': (page - 1) * RELEVE_PAGE_SIZE})
         
-        if not df_paiements.empty:
-            st.dataframe(df_paiements, use_container_width=True)
+        if not df_releve.empty:
+            nb_lignes = int(df_releve['nb_lignes'].iloc[0])
+            st.dataframe(df_releve.drop(columns='nb_lignes'), hide_index=True, use_container_width=True)
+            st.caption(f"{nb_lignes} opérations — page {page} / {-(-nb_lignes // RELEVE_PAGE_SIZE)}")
+        elif page > 1:
+            st.info("Fin du relevé : revenez à une page précédente.")
         else:
-            st.info(f"{choix_client_hist} n'a pas d'avances enregistrées.")
-    else:
+            st.info(f"{choix_client_hist} n'a ni vente ni avance enregistrée.")
+
+        if fichiers_archives('ventes') or fichiers_archives('paiements'):
+            if st.checkbox("🗄️ Afficher les opérations des mois archivés", key=f"releve_archives_{selected_client_id}"):
+                df_archive = releve_archive(selected_client_id)
+                if df_archive.empty:
+                    st.info(f"Aucune opération archivée pour {choix_client_hist}.")
+                else:
+                    st.dataframe(df_archive, hide_index=True, use_container_width=True)
+                    st.caption(f"{len(df_archive)} opérations archivées (antérieures au relevé ci-dessus).")
+    elif int(totaux['nb_clients']) == 0:
         st.info("Veuillez ajouter un client.")
 
 
 # ----------------------------------------------------
 #               ONGLET : HISTORIQUE VENTES
 # ----------------------------------------------------
-with tab_historique:
+HISTORIQUE_PAGE_SIZE = 100
+# Lignes archivées affichées au plus (les plus récentes de la période)
+HISTORIQUE_ARCHIVES_MAX = 1000
+
+
+def historique_archive(fichiers, filtre_mode, periode, client_id, produit_id):
+    """Ventes archivées correspondant aux filtres de l'historique, plus récentes d'abord (DataFrame)."""
+    filtres = []
+    if periode:
+        filtres += [('date', '>=', datetime.datetime.combine(periode[0], datetime.time())),
+                    ('date', '<', datetime.datetime.combine(periode[-1] + datetime.timedelta(days=1), datetime.time()))]
+    if client_id is not None:
+        filtres.append(('client_id', '=', client_id))
+    if produit_id is not None:
+        filtres.append(('produit_id', '=', produit_id))
+    df = lire_archives(fichiers, tuple(filtres), ['id', 'produit_id', 'quantite', 'client_id', 'montant_credit', 'date'])
+    if filtre_mode == "Ventes à Crédit 💳":
+        df = df[df['montant_credit'] > 0]
+    elif filtre_mode == "Ventes Comptant 💵":
+        df = df[df['client_id'].notna() & (df['montant_credit'] == 0)]
+    df = df.sort_values(['date', 'id'], ascending=False)
+    noms_produits = dict(cached_query("SELECT id, nom FROM produits"))
+    noms_clients = dict(cached_query("SELECT id, nom FROM clients"))
+    return pd.DataFrame({
+        "ID Vente": df['id'],
+        "Produit": df['produit_id'].map(noms_produits),
+        "Qté": df['quantite'],
+        "Client": df['client_id'].map(noms_clients),
+        "Montant Crédit (€)": df['montant_credit'],
+        "Date": df['date'],
+        "Mode de Paiement": np.select([df['montant_credit'] > 0, df['client_id'].notna()], ['CRÉDIT', 'COMPTANT'], 'N/A'),
+    })
+
+
+def page_historique():
     st.header("Historique de Toutes les Transactions")
     
     filtre_mode = st.radio(
@@ -410,14 +2693,50 @@ with tab_historique:
         ("Toutes les ventes", "Ventes à Crédit 💳", "Ventes Comptant 💵"),
         horizontal=True
     )
+
+    col_periode, col_client, col_produit = st.columns(3)
+    with col_periode:
+        aujourd_hui = datetime.date.today()
+        periode = st.date_input("Période", value=(aujourd_hui - datetime.timedelta(days=30), aujourd_hui), key="hist_periode")
+    # Filtres client et produit : seuls les premiers noms correspondant à la saisie sont chargés, jamais la table entière
+    with col_client:
+        recherche_client = st.text_input("🔎 Client (début du nom)", key="hist_client_recherche")
+        option_client = {"Tous les clients": None} | {nom: cid for cid, nom in rechercher_noms('clients', recherche_client)}
+        choix_client = st.selectbox("Client", list(option_client.keys()), key="hist_client")
+    with col_produit:
+        recherche_produit = st.text_input("🔎 Produit (début du nom)", key="hist_produit_recherche")
+        option_produit = {"Tous les produits": None} | {nom: pid for pid, nom in rechercher_noms('produits', recherche_produit)}
+        choix_produit = st.selectbox("Produit", list(option_produit.keys()), key="hist_produit")
     
-    where_clause = ""
+    conditions, params = [], []
     if filtre_mode == "Ventes à Crédit 💳":
-        where_clause = "v.montant_credit > 0"
+        conditions.append("v.montant_credit > 0")
     elif filtre_mode == "Ventes Comptant 💵":
-        where_clause = "v.client_id IS NOT NULL AND v.montant_credit = 0"
-    
-    where_sql = f"WHERE {where_clause}" if where_clause else ""
+        conditions.append("v.client_id IS NOT NULL AND v.montant_credit = 0")
+    if periode:
+        debut, fin = periode[0], periode[-1]
+        conditions.append("v.date >= %s AND v.date < %s")
+        params += [debut, fin + datetime.timedelta(days=1)]
+    if option_client[choix_client] is not None:
+        conditions.append("v.client_id = %s")
+        params.append(option_client[choix_client])
+    if option_produit[choix_produit] is not None:
+        conditions.append("v.produit_id = %s")
+        params.append(option_produit[choix_produit])
+
+    # Pagination par curseur (date, id) : chaque page est lue par l'index, quelle que soit la taille de la table.
+    # La pile contient le curseur de début de chaque page déjà visitée ; elle est remise à zéro si les filtres changent.
+    filtres = (filtre_mode, tuple(params))
+    if st.session_state.get('hist_filtres') != filtres:
+        st.session_state['hist_filtres'] = filtres
+        st.session_state['hist_curseurs'] = [None]
+    curseurs = st.session_state['hist_curseurs']
+    curseur = curseurs[-1]
+    if curseur is not None:
+        conditions.append("(v.date, v.id) < (%s, %s)")
+        params += list(curseur)
+
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ""
     
     sql_history = f"""
     SELECT 
@@ -432,33 +2751,298 @@ with tab_historique:
     JOIN produits p ON v.produit_id = p.id
     LEFT JOIN clients c ON v.client_id = c.id
     {where_sql}
-    ORDER BY v.date DESC
-    LIMIT 100
+    ORDER BY v.date DESC, v.id DESC
+    LIMIT %s
     """
-    df_history = pd.read_sql(sql_history, get_db_connection())
+    # Une ligne de plus que la page pour savoir s'il existe une page suivante
+    df_history = read_sql(sql_history, tuple(params) + (HISTORIQUE_PAGE_SIZE + 1,))
+    page_suivante = len(df_history) > HISTORIQUE_PAGE_SIZE
+    df_history = df_history.head(HISTORIQUE_PAGE_SIZE)
     st.dataframe(df_history, use_container_width=True)
 
+    def page_precedente_callback():
+        st.session_state['hist_curseurs'].pop()
+
+    def page_suivante_callback(derniere_date, dernier_id):
+        st.session_state['hist_curseurs'].append((derniere_date, dernier_id))
+
+    col_prec, col_num, col_suiv = st.columns([1, 2, 1])
+    with col_prec:
+        st.button("⬅️ Plus récentes", on_click=page_precedente_callback, disabled=len(curseurs) == 1, key="hist_prec")
+    with col_num:
+        st.caption(f"Page {len(curseurs)}")
+    with col_suiv:
+        if page_suivante:
+            derniere = df_history.iloc[-1]
+            st.button("Plus anciennes ➡️", on_click=page_suivante_callback,
+                      args=(derniere["Date"].to_pydatetime(), int(derniere["ID Vente"])), key="hist_suiv")
+        else:
+            st.button("Plus anciennes ➡️", disabled=True, key="hist_suiv")
+
+    # Les mois archivés ne sont lus (fichiers Parquet) que sur demande
+    fichiers = fichiers_archives('ventes', periode[0], periode[-1]) if periode else fichiers_archives('ventes')
+    if fichiers and st.checkbox(f"🗄️ Inclure les mois archivés de la période ({len(fichiers)} mois)", key="hist_archives"):
+        df_archive = historique_archive(fichiers, filtre_mode, periode, option_client[choix_client], option_produit[choix_produit])
+        st.dataframe(df_archive.head(HISTORIQUE_ARCHIVES_MAX), hide_index=True, use_container_width=True)
+        if len(df_archive) > HISTORIQUE_ARCHIVES_MAX:
+            st.caption(f"{HISTORIQUE_ARCHIVES_MAX} ventes archivées les plus récentes sur {len(df_archive)}.")
+        else:
+            st.caption(f"{len(df_archive)} ventes archivées.")
+
+
+# ----------------------------------------------------
+#               ONGLET : TABLEAU DE BORD
+# ----------------------------------------------------
+GRANULARITES = {"Jour": "day", "Semaine": "week", "Mois": "month"}
+# SQLite n'a pas date_trunc : équivalents par modificateurs de date (semaine commençant le lundi)
+PERIODES_SQLITE = {"day": "jour", "week": "date(jour, '-6 days', 'weekday 1')", "month": "date(jour, 'start of month')"}
+
+
+def page_tableau_de_bord():
+    st.header("📊 Tableau de Bord des Ventes")
+    # Toutes les requêtes de cette page lisent l'agrégat ventes_daily, jamais la table ventes
+
+    col_periode, col_granularite = st.columns([2, 1])
+    with col_periode:
+        aujourd_hui = datetime.date.today()
+        periode = st.date_input("Période", value=(aujourd_hui - datetime.timedelta(days=90), aujourd_hui), key="tdb_periode")
+    with col_granularite:
+        granularite = st.radio("Regrouper par", list(GRANULARITES.keys()), horizontal=True, key="tdb_granularite")
+    if not periode:
+        st.info("Choisissez une période.")
+        return
+    debut, fin = periode[0], periode[-1]
+    params = {'debut': debut, 'fin': fin, 'unite': GRANULARITES[granularite]}
+
+    df_totaux = read_sql("""
+        SELECT
+            COALESCE(SUM(chiffre_affaires), 0) AS ca,
+            COALESCE(SUM(chiffre_affaires) FILTER (WHERE mode_paiement = 'COMPTANT'), 0) AS ca_comptant,
+            COALESCE(SUM(chiffre_affaires) FILTER (WHERE mode_paiement = 'CRÉDIT'), 0) AS ca_credit,
+            COALESCE(SUM(quantite), 0) AS articles
+        FROM ventes_daily
+        WHERE jour BETWEEN %(debut)s AND %(fin)s
+    """, params)
+    totaux = df_totaux.iloc[0]
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Chiffre d'affaires", f"{totaux['ca']:.2f} €")
+    col2.metric("Comptant", f"{totaux['ca_comptant']:.2f} €")
+    col3.metric("Crédit", f"{totaux['ca_credit']:.2f} €")
+    col4.metric("Articles vendus", f"{int(totaux['articles'])}")
+
+    st.subheader(f"Chiffre d'affaires par {granularite.lower()}")
+    expr_periode = PERIODES_SQLITE[params['unite']] if DB_DIALECTE == 'sqlite' else "date_trunc(%(unite)s, jour)::date"
+    df_periodes = read_sql(f"""
+        SELECT
+            {expr_periode} AS periode,
+            COALESCE(SUM(chiffre_affaires) FILTER (WHERE mode_paiement = 'COMPTANT'), 0) AS "Comptant",
+            COALESCE(SUM(chiffre_affaires) FILTER (WHERE mode_paiement = 'CRÉDIT'), 0) AS "Crédit"
+        FROM ventes_daily
+        WHERE jour BETWEEN %(debut)s AND %(fin)s
+        GROUP BY 1
+        ORDER BY 1
+    """, params)
+    if df_periodes.empty:
+        st.info("Aucune vente sur la période.")
+        return
+    df_periodes['periode'] = pd.to_datetime(df_periodes['periode'])
+    st.bar_chart(df_periodes.set_index('periode'))
+
+    st.subheader("Meilleurs produits")
+    df_top = read_sql("""
+        SELECT p.nom AS "Produit", t.quantite AS "Qté vendue", t.ca AS "Chiffre d'affaires (€)"
+        FROM (
+            SELECT produit_id, SUM(quantite) AS quantite, SUM(chiffre_affaires) AS ca
+            FROM ventes_daily
+            WHERE jour BETWEEN %(debut)s AND %(fin)s
+            GROUP BY produit_id
+            ORDER BY ca DESC
+            LIMIT 10
+        ) t
+        JOIN produits p ON p.id = t.produit_id
+        ORDER BY t.ca DESC
+    """, params)
+    st.dataframe(df_top, hide_index=True, use_container_width=True)
+
 
 # ----------------------------------------------------
 #               ONGLET : STOCK
 # ----------------------------------------------------
-with tab_stock:
+STOCK_PAGE_SIZE = 200
+
+
+def page_stock():
     st.header("État du Stock Actuel")
-    sql_stock_etat = """SELECT id, nom, prix, quantite FROM produits ORDER BY id"""
-    df = pd.read_sql(sql_stock_etat, get_db_connection())
-    st.dataframe(df, use_container_width=True)
+    page = st.number_input("Page", min_value=1, value=1, step=1, key="stock_page")
+    sql_stock_etat = """SELECT id, nom, code_barre, prix, quantite, COUNT(*) OVER () AS nb_produits FROM produits ORDER BY id LIMIT %s OFFSET %s"""
+    df = read_sql(sql_stock_etat, (STOCK_PAGE_SIZE, (page - 1) * STOCK_PAGE_SIZE))
+    if not df.empty:
+        nb_produits = int(df['nb_produits'].iloc[0])
+        st.dataframe(df.drop(columns='nb_produits'), use_container_width=True)
+        st.caption(f"{nb_produits} produits — page {page} / {-(-nb_produits // STOCK_PAGE_SIZE)}")
+    elif page > 1:
+        st.info("Fin de la liste : revenez à une page précédente.")
+    else:
+        st.info("Aucun produit enregistré.")
+
+    st.markdown("---")
+    st.subheader("🔍 Contrôle du stock")
+    st.caption("Compare le stock de chaque produit à la somme de ses mouvements (ventes, imports, créations).")
+    if st.button("Vérifier le journal des mouvements", key="stock_controle"):
+        df_ecarts = read_sql("""
+            SELECT p.id, p.nom, p.quantite AS "Stock", COALESCE(m.total, 0) AS "Somme des mouvements",
+                   p.quantite - COALESCE(m.total, 0) AS "Écart"
+            FROM produits p
+            LEFT JOIN (SELECT produit_id, SUM(delta) AS total FROM mouvements_stock GROUP BY produit_id) m ON m.produit_id = p.id
+            WHERE COALESCE(p.quantite, 0) <> COALESCE(m.total, 0)
+            ORDER BY p.id
+        """)
+        if df_ecarts.empty:
+            st.success("✅ Le stock de tous les produits correspond au journal.")
+        else:
+            st.warning(f"{len(df_ecarts)} produits présentent un écart avec le journal :")
+            st.dataframe(df_ecarts, hide_index=True, use_container_width=True)
+
+    st.markdown("---")
+    st.subheader("📤 Exporter")
+    col_table, col_format = st.columns(2)
+    with col_table:
+        choix_export = st.selectbox("Données", list(EXPORTS.keys()), key="export_table")
+    with col_format:
+        format_fichier = st.radio("Format", ("csv", "parquet"), horizontal=True, key="export_format")
+    nom_fichier, sql_export = EXPORTS[choix_export]
+    avec_archives = (nom_fichier in ARCHIVE_COLONNES and bool(fichiers_archives(nom_fichier))
+                     and st.checkbox("Inclure les mois archivés", key="export_archives"))
+    # L'export n'est produit qu'à la demande, jamais à chaque rerun de la page ; seul le fichier
+    # final (compressé pour le Parquet) est remis à Streamlit pour le téléchargement.
+    if st.button("Préparer l'export", key="export_preparer"):
+        if avec_archives:
+            fichier = export_avec_archives(nom_fichier, sql_export, format_fichier)
+        else:
+            # Mêmes types Parquet qu'avec les mois archivés (prix_unitaire reste un float même s'il est entier)
+            fichier = export_table(sql_export, format_fichier, ARCHIVE_COLONNES.get(nom_fichier))
+        with fichier:
+            st.download_button(
+                f"⬇️ Télécharger {nom_fichier}.{format_fichier}", fichier.read(),
+                file_name=f"{nom_fichier}_{datetime.date.today():%Y%m%d}.{format_fichier}",
+                mime="text/csv" if format_fichier == 'csv' else "application/vnd.apache.parquet",
+                key="export_telecharger",
+            )
+
+    st.markdown("---")
+    st.subheader("🗄️ Mois archivés")
+    if ARCHIVE_RETENTION_MOIS:
+        st.caption(f"Les ventes et paiements de plus de {max(ARCHIVE_RETENTION_MOIS, ARCHIVE_RETENTION_MIN)} mois "
+                   f"sont déplacés dans {os.path.abspath(ARCHIVE_DIR)} (Parquet).")
+        if st.button("Archiver maintenant", key="archives_lancer"):
+            try:
+                archives = archiver_mois_anciens()
+            except ArchiveError as e:
+                st.warning(f"Archivage reporté : {e}")
+            else:
+                st.success(f"✅ {len(archives)} mois archivés." if archives else "Aucun mois à archiver (ou archivage déjà en cours).")
+    else:
+        st.caption("Archivage désactivé (ARCHIVE_RETENTION_MOIS=0).")
+    df_archives = read_sql("""SELECT table_nom AS "Table", mois AS "Mois", nb_lignes AS "Lignes", archive_le AS "Archivé le", fichier AS "Fichier"
+                              FROM archives ORDER BY mois DESC, table_nom""")
+    if not df_archives.empty:
+        st.dataframe(df_archives, hide_index=True, use_container_width=True)
 
 # ----------------------------------------------------
 #               ONGLET : AJOUTER PRODUIT
 # ----------------------------------------------------
-with tab_ajouter:
+def page_ajouter():
     st.header("Nouveau Produit")
     with st.form("ajout_produit_form_simple"):
         nom = st.text_input("Nom du produit")
         prix = st.number_input("Prix de vente", min_value=0.0, step=100.0)
         qty = st.number_input("Quantité initiale", min_value=1, step=1)
+        code_barre = st.text_input("Code-barres / SKU (optionnel)")
         
         if st.form_submit_button("Ajouter le Produit"):
-            sql = "INSERT INTO produits (nom, prix, quantite) VALUES (%s, %s, %s)"
-            exec_query(sql, (nom, prix, qty))
+            valeurs = (nom, prix, qty, code_barre.strip() or None)
+            # Deux instructions dans la même transaction (SQLite n'accepte pas d'INSERT dans un WITH)
+            try:
+                with db_transaction() as conn:
+                    with conn.cursor() as c:
+                        c.execute("INSERT INTO produits (nom, prix, quantite, code_barre) VALUES (%s, %s, %s, %s) RETURNING id, quantite", valeurs)
+                        c.execute("INSERT INTO mouvements_stock (produit_id, delta, motif) VALUES (%s, %s, 'CRÉATION')", c.fetchone())
+                        notify_write(c)
+            except (psycopg2.IntegrityError, sqlite3.IntegrityError) as e:
+                st.error(f"❌ Produit non ajouté (code-barres déjà attribué ?) : {e}")
+                return
+            except (psycopg2.Error, sqlite3.Error) as e:
+                st.error(f"❌ Produit non ajouté : {e}")
+                return
+            get_data_version().bump()
             st.success(f"✅ Produit '{nom}' ajouté !")
+
+    st.markdown("---")
+    st.subheader("📥 Import en masse (catalogue fournisseur, inventaire)")
+    st.caption("Fichier CSV avec l'en-tête nom,prix,quantite et en option code_barre (séparateur , ou ;). Un produit existant (même nom) est mis à jour, sinon il est créé.")
+    with st.form("import_produits_form", clear_on_submit=True):
+        fichier = st.file_uploader("Fichier CSV", type=["csv"])
+        mode_quantite = st.radio(
+            "Quantités du fichier",
+            ("Remplacent le stock (inventaire)", "S'ajoutent au stock (réassort)"),
+            horizontal=True
+        )
+        if st.form_submit_button("Importer") and fichier is not None:
+            try:
+                nb_maj, nb_crees, df_rejets = import_produits_csv(fichier, ajouter_quantites=mode_quantite.startswith("S'ajoutent"))
+            except ImportProduitsError as e:
+                st.error(f"❌ Import annulé : {e}")
+            else:
+                st.success(f"✅ Import terminé : {nb_crees} produits créés, {nb_maj} mis à jour.")
+                if not df_rejets.empty:
+                    st.warning(f"{len(df_rejets)} lignes rejetées (nom vide, prix ou quantité invalide) :")
+                    st.dataframe(df_rejets, hide_index=True, use_container_width=True)
+
+
+# --- NAVIGATION : SEULE LA PAGE ACTIVE EST EXÉCUTÉE À CHAQUE RERUN ---
+
+pg = st.navigation([
+    st.Page(page_vendre, title="Vendre", icon="🛒", default=True),
+    st.Page(page_clients, title="Clients & Crédit", icon="👤"),
+    st.Page(page_remboursement, title="Remboursement Client", icon="💵"),
+    st.Page(page_creances, title="Créances", icon="📒"),
+    st.Page(page_historique, title="Historique Ventes", icon="🧾"),
+    st.Page(page_tableau_de_bord, title="Tableau de Bord", icon="📊"),
+    st.Page(page_stock, title="Stock", icon="📦"),
+    st.Page(page_ajouter, title="Ajouter Produit", icon="➕"),
+], position="top")
+try:
+    pg.run()
+finally:
+    rerun_stats = get_query_metrics().fin_rerun() if QUERY_METRICS else None
+    if rerun_stats is not None:
+        cumuler_rerun(rerun_stats)
+
+
+# ----------------------------------------------------
+#               BARRE LATÉRALE : SUPERVISION
+# ----------------------------------------------------
+with st.sidebar.expander("🔌 Pool de connexions DB"):
+    st.json(get_db_pool().stats())
+
+if WRITE_BEHIND:
+    with st.sidebar.expander("🔄 Écritures différées"):
+        compte, rejets = get_write_behind().etat()
+        st.metric("En attente de synchronisation", compte.get('EN_ATTENTE', 0))
+        st.metric("Rejetées", compte.get('REJETEE', 0))
+        for cree_le, type_operation, donnees, erreur in rejets:
+            st.caption(f"{datetime.datetime.fromtimestamp(cree_le):%d/%m %H:%M} — {type_operation} : {erreur}")
+
+if ADMIN_METRICS and rerun_stats is not None:
+    with st.sidebar.expander("⏱️ Requêtes de ce rerun"):
+        totaux = rerun_stats.totaux()
+        st.caption(f"Rerun : {1000 * rerun_stats.duree_s:.0f} ms, dont SQL : {totaux['duree_sql_ms']:.0f} ms")
+        st.caption(f"{totaux['requetes']} requête(s), {totaux['emprunts_connexion']} emprunt(s) de connexion, "
+                   f"{totaux['connexions_ouvertes']} connexion(s) ouverte(s), {totaux['erreurs']} erreur(s)")
+        if rerun_stats.requetes:
+            detail = pd.DataFrame(
+                [(sql, n, 1000 * duree, lignes, erreurs) for sql, (n, duree, lignes, erreurs) in rerun_stats.requetes.items()],
+                columns=['Requête', 'Nb', 'ms', 'Lignes', 'Erreurs'],
+            ).sort_values('ms', ascending=False)
+            st.dataframe(detail, hide_index=True, use_container_width=True,
+                         column_config={"ms": st.column_config.NumberColumn(format="%.1f")})
@@ -0,0 +1,166 @@
+"""Test de charge des encaissements concurrents : plusieurs caisses (threads) vendent et encaissent en même temps.
+
+Les caisses appellent directement checkout() et enregistrer_paiement() de app.py sur un petit
+catalogue et quelques clients au plafond serré, pour maximiser les conflits sur les mêmes lignes.
+À la fin, les invariants sont vérifiés ; le script sort en erreur si l'un d'eux est violé :
+    - aucun stock négatif ;
+    - aucun client au-delà de son plafond (ni solde négatif) ;
+    - le journal mouvements_stock correspond à produits.quantite ;
+    - solde_du = crédits accordés - paiements reçus, pour chaque client ;
+    - stock vendu = quantités des ventes, et la table de synthèse ventes_daily = ventes.
+
+Base : PostgreSQL jetable comme bench/benchmark.py (--admin-url ou pgserver), ou fichier SQLite (--sqlite).
+
+Exemples :
+    python bench/stress_caisses.py
+    python bench/stress_caisses.py --caisses 32 --ventes-par-caisse 200
+    python bench/stress_caisses.py --sqlite
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark import BaseJetable
+
+STOCK_INITIAL = 2000
+
+
+def caisse(app, numero, args, produits, clients, compteurs, verrou):
+    """Une caisse : ventes comptant ou à crédit de 1 à 5 articles, et paiements de temps en temps."""
+    rnd = random.Random(args.graine + numero)
+    for _ in range(args.ventes_par_caisse):
+        panier = []
+        for pid, nom, prix in rnd.sample(produits, rnd.randint(1, min(5, len(produits)))):
+            quantite = rnd.randint(1, 6)
+            panier.append({'id': pid, 'nom': nom, 'prix_u': prix, 'quantite': quantite, 'total': prix * quantite})
+        credit = rnd.random() < 0.5
+        try:
+            app.checkout(panier, rnd.choice(clients) if credit else None, credit)
+            resultat = 'ventes'
+        except app.CheckoutError:
+            resultat = 'refus'
+        except Exception as e:
+            resultat = 'erreurs'
+            print(f"Caisse {numero} : {type(e).__name__} : {e}", file=sys.stderr)
+        if credit and rnd.random() < 0.3:
+            try:
+                app.enregistrer_paiement(rnd.choice(clients), 20.0)
+                with verrou:
+                    compteurs['paiements'] += 1
+            except app.PaiementError:
+                pass
+        with verrou:
+            compteurs[resultat] += 1
+
+
+def verifier_invariants(app):
+    """Renvoie la liste des invariants violés (vide si tout est cohérent)."""
+    def valeur(sql):
+        return app.exec_query(sql, fetch=True)[0][0]
+
+    violations = []
+    n = valeur("SELECT COUNT(*) FROM produits WHERE quantite < 0")
+    if n:
+        violations.append(f"{n} produit(s) en stock négatif")
+    n = valeur("SELECT COUNT(*) FROM clients WHERE solde_du > plafond_credit + 0.005 OR solde_du < -0.005")
+    if n:
+        violations.append(f"{n} client(s) au-delà du plafond ou en solde négatif")
+    n = valeur(
+        """SELECT COUNT(*) FROM produits p
+           LEFT JOIN (SELECT produit_id, SUM(delta) AS total FROM mouvements_stock GROUP BY produit_id) m
+             ON m.produit_id = p.id
+           WHERE p.quantite <> COALESCE(m.total, 0)"""
+    )
+    if n:
+        violations.append(f"{n} produit(s) dont le stock diffère du journal mouvements_stock")
+    n = valeur(
+        """SELECT COUNT(*) FROM clients c
+           WHERE abs(c.solde_du
+                     - COALESCE((SELECT SUM(montant_credit) FROM ventes v WHERE v.client_id = c.id), 0)
+                     + COALESCE((SELECT SUM(montant) FROM paiements p WHERE p.client_id = c.id), 0)) > 0.005"""
+    )
+    if n:
+        violations.append(f"{n} client(s) dont solde_du diffère de crédits - paiements")
+    vendu = valeur(f"SELECT {STOCK_INITIAL} * COUNT(*) - SUM(quantite) FROM produits")
+    ventes = valeur("SELECT COALESCE(SUM(quantite), 0) FROM ventes")
+    if vendu != ventes:
+        violations.append(f"stock vendu ({vendu}) différent des quantités vendues ({ventes})")
+    synthese = valeur("SELECT COALESCE(SUM(quantite), 0) FROM ventes_daily")
+    if synthese != ventes:
+        violations.append(f"ventes_daily ({synthese}) différent de ventes ({ventes})")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--admin-url', default=os.environ.get('BENCH_ADMIN_URL'))
+    parser.add_argument('--sqlite', action='store_true', help="fichier SQLite temporaire au lieu de PostgreSQL")
+    parser.add_argument('--caisses', type=int, default=16)
+    parser.add_argument('--ventes-par-caisse', type=int, default=60)
+    parser.add_argument('--produits', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=3)
+    parser.add_argument('--plafond', type=float, default=5000)
+    parser.add_argument('--graine', type=int, default=42)
+    args = parser.parse_args()
+
+    dossier = tempfile.TemporaryDirectory(prefix='stress_caisses_')
+    base = None
+    try:
+        if args.sqlite:
+            url = f"sqlite:///{os.path.join(dossier.name, 'stress.db')}"
+        else:
+            base = BaseJetable(args.admin_url)
+            url = base.url
+        os.environ.update({
+            'DATABASE_URL': url,
+            'WRITE_BEHIND': '0',
+            'DB_POOL_MAX': str(args.caisses + 4),
+        })
+        # Importé après la configuration : app.py lit l'environnement et applique les migrations au chargement
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import app
+
+        catalogue = "nom,prix,quantite\n" + "".join(
+            f"Produit {i},{i + 1},{STOCK_INITIAL}\n" for i in range(1, args.produits + 1))
+        app.import_produits_csv(io.BytesIO(catalogue.encode()))
+        for i in range(1, args.clients + 1):
+            app.exec_query("INSERT INTO clients (nom, plafond_credit) VALUES (%s, %s)", (f"Client {i}", args.plafond))
+        produits = app.exec_query("SELECT id, nom, prix FROM produits", fetch=True)
+        clients = [r[0] for r in app.exec_query("SELECT id FROM clients", fetch=True)]
+
+        compteurs = {'ventes': 0, 'refus': 0, 'erreurs': 0, 'paiements': 0}
+        verrou = threading.Lock()
+        debut = time.perf_counter()
+        threads = [threading.Thread(target=caisse, args=(app, i, args, produits, clients, compteurs, verrou))
+                   for i in range(args.caisses)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        duree = time.perf_counter() - debut
+
+        print(f"{args.caisses} caisses en {duree:.1f} s : {compteurs['ventes']} ventes, {compteurs['refus']} refusées "
+              f"(stock ou plafond), {compteurs['paiements']} paiements, {compteurs['erreurs']} erreurs")
+        print(f"Pool : {app.get_db_pool().stats()}")
+        violations = verifier_invariants(app)
+        if compteurs['erreurs']:
+            violations.append(f"{compteurs['erreurs']} vente(s) en erreur inattendue")
+    finally:
+        if base is not None:
+            base.supprimer()
+        dossier.cleanup()
+
+    for violation in violations:
+        print(f"ÉCHEC : {violation}")
+    if violations:
+        sys.exit(1)
+    print("Invariants respectés.")
+
+
+if __name__ == '__main__':
+    main()